@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Scale-out benchmark of okopilote-room with simulated rooms.
+
+Rooms are built from a generated rooms config, with in-process fake sensors
+(configurable latency and failure rate) and fake valves counting their
+commands, then run by the threads or the loop engine. For each number of
+rooms, the benchmark measures the tick cost, CPU per room, threads and
+memory footprint, the duration of each tick stage (scheduler included) and
+the latency and throughput of the API. Results are written in JSON.
+
+    python benchmarks/bench_rooms.py --rooms 10,100,500,2000 -o bench.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from okopilote.room import room
+from okopilote.room.__about__ import __version__
+from okopilote.room.actuation import ActuatorHub
+from okopilote.room.api import API
+from okopilote.room.engine import RoomEngine
+from okopilote.room.persistence import Persister
+from okopilote.room.scheduler import ScheduleDispatcher
+from okopilote.room.sensors import SensorHub
+
+
+class FakeSensor:
+    """
+    Temperature and humidity sensor following a slow random walk.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.temp = self.random.uniform(17.0, 21.0)
+        self.reads = 0
+
+    def _read(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self.reads += 1
+        if self.random.random() < self.failure_rate:
+            raise OSError("simulated sensor failure")
+        self.temp += self.random.gauss(0, 0.05)
+        return self.temp
+
+    @property
+    def temperature(self):
+        return self._read()
+
+    @property
+    def humidity(self):
+        self._read()
+        return 50.0
+
+    @property
+    def temperature_humidity(self):
+        return (self._read(), 50.0)
+
+
+class FakeValve:
+    def __init__(self):
+        self.commands = 0
+
+    def open(self):
+        self.commands += 1
+
+    def close(self):
+        self.commands += 1
+
+    def release(self):
+        self.commands += 1
+
+
+class FakeDevices:
+    """
+    Factory of the fake devices by name: "valve..." names are valves, the
+    other names are sensors.
+    """
+
+    def __init__(self, latency, failure_rate):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sensors = {}
+        self.valves = {}
+
+    def get_device(self, name):
+        if name.startswith("valve"):
+            return self.valves.setdefault(name, FakeValve())
+        return self.sensors.setdefault(
+            name, FakeSensor(self.latency, self.failure_rate, seed=name)
+        )
+
+
+class BenchApp:
+    """
+    Minimal stand-in for App, serving the benchmark rooms to the API.
+    """
+
+    rooms = {}
+
+    @classmethod
+    def push_circulator_state(cls, state):
+        room.Room.push_circulator_state(state)
+
+
+def rss():
+    """
+    Return the resident memory of the process in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def write_rooms_conf(path, n, args, data_dir):
+    with open(path, "w") as f:
+        f.write("[DEFAULT]\n")
+        f.write("period = {}\n".format(args.period))
+        f.write("data_dir = {}\n".format(data_dir))
+        f.write("history_size = {}\n".format(args.history_size))
+        for i in range(n):
+            sensor = "sensor{}".format(i // args.rooms_per_sensor)
+            f.write("[room{}]\n".format(i))
+            f.write("temperature_sensor_device = {}\n".format(sensor))
+            f.write("humidity_sensor_device = {}\n".format(sensor))
+            f.write("radiator_valve_device = valve{}\n".format(i))
+
+
+def load_api(port, method, path, body, duration, clients):
+    """
+    Send requests from client threads on keep-alive connections during the
+    duration. Return the latency and throughput figures.
+    """
+    latencies = []
+    errors = [0]
+    reconnects = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    headers = {"Content-Type": "application/json"} if body else {}
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        mine = []
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 200:
+                    raise http.client.HTTPException(resp.status)
+            except http.client.RemoteDisconnected:
+                # Keep-alive connection closed by the server
+                with lock:
+                    reconnects[0] += 1
+                conn.close()
+                continue
+            except (OSError, http.client.HTTPException):
+                with lock:
+                    errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            mine.append(time.monotonic() - start)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "reconnects": reconnects[0],
+        "throughput": round(len(latencies) / elapsed, 1),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies) if latencies else None,
+    }
+
+
+def run_rooms(n, args, port):
+    """
+    Run n rooms during the benchmark duration and return their figures.
+    """
+    fake = FakeDevices(args.sensor_latency, args.sensor_failure_rate)
+    threads_before = threading.active_count()
+    rss_before = rss()
+    with tempfile.TemporaryDirectory() as data_dir:
+        conf_file = os.path.join(data_dir, "rooms.conf")
+        write_rooms_conf(conf_file, n, args, data_dir)
+        engine = RoomEngine(workers=args.workers) if args.engine == "loop" else None
+        dispatcher = ScheduleDispatcher()
+        persister = Persister()
+        sensors = SensorHub(
+            ttl=args.sensor_cache_ttl,
+            timeout=args.sensor_timeout,
+            get_device=fake.get_device,
+        )
+        actuators = ActuatorHub(get_device=fake.get_device)
+        rooms = room.from_file(
+            conf_file,
+            engine=engine,
+            sensors=sensors,
+            dispatcher=dispatcher,
+            persister=persister,
+            actuators=actuators,
+            stagger=True,
+        )
+        for r in rooms.values():
+            r.profiler.enable()
+            r.start()
+        BenchApp.rooms = rooms
+        try:
+            # Let every room tick once before measuring
+            time.sleep(args.period * 1.5)
+            ticks = sum(r.ticker.ticks for r in rooms.values())
+            reads = sum(s.reads for s in fake.sensors.values())
+            cpu = time.process_time()
+            start = time.monotonic()
+            time.sleep(args.duration)
+            elapsed = time.monotonic() - start
+            cpu = time.process_time() - cpu
+            ticks = sum(r.ticker.ticks for r in rooms.values()) - ticks
+            reads = sum(s.reads for s in fake.sensors.values()) - reads
+            footprint = {
+                "threads": threading.active_count() - threads_before,
+                "rss_bytes": rss() - rss_before,
+            }
+            stats = [r.ticker.stats() for r in rooms.values()]
+            stages = {}
+            for r in rooms.values():
+                for stage, s in r.profiler.stats()["stages"].items():
+                    stages.setdefault(stage, []).append(s["mean"])
+            body = json.dumps(
+                {
+                    "rooms": {k: {"temp_set_offset": 0.2} for k in rooms},
+                    "circulator_runs": True,
+                }
+            )
+            api = {}
+            if args.api_duration > 0:
+                for name, method, path, data in (
+                    ("rooms", "GET", "/api/rooms/all", None),
+                    ("controller_sync", "POST", "/api/rooms/all/controller_sync", body),
+                    ("dump", "GET", "/api/rooms/all/dump", None),
+                ):
+                    api[name] = load_api(
+                        port, method, path, data, args.api_duration, args.api_clients
+                    )
+        finally:
+            for r in rooms.values():
+                r.stop()
+            if engine is not None:
+                engine.stop()
+            dispatcher.stop()
+            persister.stop()
+            actuators.stop()
+            sensors.stop()
+            BenchApp.rooms = {}
+    durations = [s["duration_mean"] for s in stats if s["duration_mean"] is not None]
+    lateness = [s["lateness_mean"] for s in stats if s["lateness_mean"] is not None]
+    return {
+        "rooms": n,
+        "duration": round(elapsed, 3),
+        "ticks": ticks,
+        "ticks_per_second": round(ticks / elapsed, 1),
+        "expected_ticks_per_second": round(n / args.period, 1),
+        "tick_duration_mean": sum(durations) / len(durations) if durations else None,
+        "tick_duration_max": max(s["duration_max"] for s in stats),
+        "tick_lateness_mean": sum(lateness) / len(lateness) if lateness else None,
+        "tick_lateness_max": max(s["lateness_max"] for s in stats),
+        "overruns": sum(s["overruns"] for s in stats),
+        "skipped": sum(s["skipped"] for s in stats),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_percent_per_room": round(100 * cpu / elapsed / n, 4),
+        "cpu_seconds_per_tick": cpu / ticks if ticks else None,
+        "stage_duration_mean": {k: sum(v) / len(v) for k, v in stages.items()},
+        "sensor_reads": reads,
+        "valve_commands": sum(v.commands for v in fake.valves.values()),
+        "footprint": footprint,
+        "rss_bytes_per_room": footprint["rss_bytes"] // n,
+        "api": api,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--rooms",
+        default="10,100,500,2000",
+        help="Comma separated numbers of rooms. Default: %(default)s",
+    )
+    parser.add_argument("--engine", choices=("threads", "loop"), default="loop")
+    parser.add_argument("--workers", type=int, default=4, help="Loop engine workers")
+    parser.add_argument("--period", type=float, default=1.0, help="Room period")
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="Seconds of measure"
+    )
+    parser.add_argument("--history-size", type=int, default=360)
+    parser.add_argument("--rooms-per-sensor", type=int, default=1)
+    parser.add_argument("--sensor-latency", type=float, default=0.0)
+    parser.add_argument("--sensor-failure-rate", type=float, default=0.0)
+    parser.add_argument("--sensor-timeout", type=float, default=3.0)
+    parser.add_argument("--sensor-cache-ttl", type=float, default=0.5)
+    parser.add_argument(
+        "--api-duration", type=float, default=3.0, help="Seconds per endpoint"
+    )
+    parser.add_argument("--api-clients", type=int, default=4)
+    parser.add_argument("-o", "--output", help="JSON result file. Default: stdout")
+    args = parser.parse_args()
+
+    port = free_port()
+    api = API(
+        BenchApp,
+        addr="127.0.0.1",
+        port=port,
+        server="threaded",
+        workers=8,
+        quiet=True,
+    )
+    threading.Thread(target=api.start, daemon=True).start()
+    time.sleep(0.5)
+
+    results = []
+    for n in (int(x) for x in args.rooms.split(",")):
+        print("{} rooms...".format(n), file=sys.stderr)
+        results.append(run_rooms(n, args, port))
+    report = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.time(),
+        "params": vars(args),
+        "results": results,
+    }
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
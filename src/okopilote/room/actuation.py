@@ -0,0 +1,264 @@
+import logging
+from configparser import ConfigParser
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+from okopilote.devices.common import devices
+
+from .metrics import VALVE_COMMANDS, VALVE_FAILURES
+
+logger = logging.getLogger(__name__)
+
+
+def boards_from_file(devices_conf_file):
+    """
+    Return the relay board of each valve device of the devices config file,
+    by device name: the board_url of its relay_device, or of the device.
+    """
+    conf = ConfigParser()
+    conf.read(devices_conf_file)
+    boards = {}
+    for name in conf.sections():
+        section = conf[name]
+        relay = section.get("relay_device")
+        if relay and conf.has_option(relay, "board_url"):
+            boards[name] = conf[relay]["board_url"]
+        elif section.get("board_url"):
+            boards[name] = section["board_url"]
+    return boards
+
+
+class ValveChannel:
+    """
+    Proxy of a valve device that forwards an order to its relay board only
+    when it differs from the last one written, or when the refresh interval
+    has elapsed since. Orders never block: the board writes them from its
+    own thread, and a failed write is raised by the next order.
+    """
+
+    def __init__(self, name, device, board, refresh_interval=600.0):
+        self.name = name
+        self.device = device
+        self.board = board
+        self.refresh_interval = refresh_interval
+        self.sent = None  # Last order written
+        self.sent_at = 0.0
+        self.error = None
+        self.writes = 0
+
+    def open(self):
+        self._order("open")
+
+    def close(self):
+        self._order("close")
+
+    def release(self):
+        self._order("release")
+
+    def _order(self, order):
+        error = self.error
+        self.board.request(self, order)
+        if error is not None:
+            raise error
+
+    def is_due(self, order):
+        """
+        Return True if the order has to be written to the device.
+        """
+        return order != self.sent or monotonic() - self.sent_at >= self.refresh_interval
+
+
+class BoardFlusher:
+    """
+    Single thread writing the pending orders of the relay boards once their
+    flush delay has elapsed, so that the number of threads does not grow
+    with the number of boards. The delay of a board runs from its first
+    pending order.
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+        self.deadlines = {}  # RelayBoard -> monotonic time of its flush
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        with self.cond:
+            if self.thread is not None:
+                return
+            self.stopped = False
+            self.thread = Thread(target=self._loop, name="valve-flusher", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stop the thread after having written the pending orders.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+            boards, self.deadlines = list(self.deadlines), {}
+        for board in boards:
+            board.flush()
+        self.thread = None
+
+    def schedule(self, board):
+        """
+        Flush the board after its flush delay, unless already scheduled.
+        """
+        with self.cond:
+            if board not in self.deadlines:
+                self.deadlines[board] = monotonic() + board.flush_delay
+                self.cond.notify()
+        self.start()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.stopped:
+                        return
+                    now = monotonic()
+                    due = [b for b, t in self.deadlines.items() if t <= now]
+                    if due:
+                        for board in due:
+                            del self.deadlines[board]
+                        break
+                    timeout = None
+                    if self.deadlines:
+                        timeout = min(self.deadlines.values()) - now
+                    self.cond.wait(timeout)
+            for board in due:
+                board.flush()
+
+
+class RelayBoard:
+    """
+    Relay board shared by valves. The orders requested during the flush
+    delay are written together, in one pass, by the thread of the flusher.
+    """
+
+    def __init__(self, name, flush_delay=0.5, flusher=None):
+        self.name = name
+        self.flush_delay = flush_delay
+        self.flusher = flusher if flusher is not None else BoardFlusher()
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.pending = {}  # ValveChannel -> order
+
+    def stop(self):
+        """
+        Write the pending orders.
+        """
+        self.flush()
+
+    def request(self, channel, order):
+        with self.lock:
+            if not channel.is_due(order):
+                # Back to the written order before the flush
+                self.pending.pop(channel, None)
+                return
+            self.pending[channel] = order
+        self.flusher.schedule(self)
+
+    def flush(self):
+        """
+        Write the pending orders now, in the calling thread.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        self._write(pending)
+
+    def _write(self, pending):
+        if not pending:
+            return
+        with self.write_lock:
+            for channel, order in pending.items():
+                try:
+                    getattr(channel.device, order)()
+                except Exception as e:
+                    logger.error(
+                        'valve "{}": failed to {}: {}'.format(channel.name, order, e)
+                    )
+                    channel.sent = None
+                    channel.error = e
+                    VALVE_FAILURES.inc(channel.name, order)
+                else:
+                    channel.sent = order
+                    channel.sent_at = monotonic()
+                    channel.error = None
+                    channel.writes += 1
+                    VALVE_COMMANDS.inc(channel.name, order)
+        logger.debug(
+            'board "{}": wrote {} valve order(s)'.format(self.name, len(pending))
+        )
+
+
+class ActuatorHub:
+    """
+    Registry of the valve devices used by rooms, that gives the same
+    ValveChannel to every room referring to a given device name. Valves of
+    the same relay board share one RelayBoard, and the boards are flushed by
+    one BoardFlusher. Devices are created by `get_device`, the devices
+    library by default.
+    """
+
+    def __init__(
+        self, refresh_interval=600.0, flush_delay=0.5, boards=None, get_device=None
+    ):
+        self.get_device = get_device or devices.get_device
+        self.refresh_interval = refresh_interval
+        self.flush_delay = flush_delay
+        self.boards_by_device = boards or {}
+        self.lock = Lock()
+        self.valves = {}
+        self.boards = {}
+        self.flusher = BoardFlusher()
+
+    def get(self, name):
+        """
+        Return the valve channel for the device name, or None if no name.
+        """
+        if not name:
+            return None
+        with self.lock:
+            try:
+                return self.valves[name]
+            except KeyError:
+                device = self.get_device(name)
+                if device is None:
+                    return None
+                board_name = self.boards_by_device.get(name, name)
+                try:
+                    board = self.boards[board_name]
+                except KeyError:
+                    board = RelayBoard(
+                        board_name, flush_delay=self.flush_delay, flusher=self.flusher
+                    )
+                    self.boards[board_name] = board
+                valve = ValveChannel(
+                    name, device, board, refresh_interval=self.refresh_interval
+                )
+                self.valves[name] = valve
+                return valve
+
+    def forget(self, names, boards=None):
+        """
+        Drop the valves of the device names, to be created again from the
+        devices config on next use, with the new board of each device.
+        """
+        with self.lock:
+            if boards is not None:
+                self.boards_by_device = boards
+            for name in names:
+                self.valves.pop(name, None)
+
+    def stop(self):
+        """
+        Write the pending orders and stop the flusher.
+        """
+        self.flusher.stop()
+        with self.lock:
+            boards = list(self.boards.values())
+        for board in boards:
+            board.stop()
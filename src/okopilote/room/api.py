@@ -1,20 +1,46 @@
 import json
-from bottle import Bottle, JSONPlugin, abort, request, response
+from threading import BoundedSemaphore
+from time import monotonic
+
+from bottle import Bottle, HTTPResponse, JSONPlugin, abort, request, response, run
 
 # from bottle import static_file, view
 
+from .metrics import API_REQUEST, REGISTRY
 from .room import Room
+from .server import make_server
+from .snapshot import etag, heat_demand, join_bodies, wait_newer
 
 
 class API:
 
-    def __init__(self, app, addr="0.0.0.0", port="8882"):
+    def __init__(
+        self,
+        app,
+        addr="0.0.0.0",
+        port="8882",
+        server="wsgiref",
+        max_streams=4,
+        quiet=False,
+        **options,
+    ):
         self.app = app
         self.addr = addr
         self.port = port
+        self.server = server
+        self.max_streams = max_streams
+        self.quiet = quiet
+        self.server_options = options
 
     def start(self):
         mybottle = Bottle()
+        # Event streams and long-polls hold a worker while open: past the
+        # limit they are refused, so that other requests still get a worker
+        streams = BoundedSemaphore(self.max_streams)
+
+        def acquire_stream():
+            if not streams.acquire(blocking=False):
+                abort(503, "Too many event streams, retry later")
 
         def id_to_rooms(rooms_id):
             if rooms_id == "all":
@@ -35,44 +61,134 @@ class API:
         def enable_OPTIONS_method(any=None):
             pass
 
+        @mybottle.get("/metrics")
+        def metrics():
+            response.content_type = "text/plain; version=0.0.4"
+            return REGISTRY.render()
+
         @mybottle.get("/api/rooms/<room_id>")
         def api_room(room_id):
             rooms = id_to_rooms(room_id)
-            data = {}
-            for id_, r in rooms.items():
-                data[id_] = {
-                    k: v
-                    for k, v in vars(r).items()
-                    if k
-                    in [
-                        "errors",
-                        "label",
-                        "room_id",
-                        "temp",
-                        "temp_controlled",
-                        "temp_set",
-                        "temp_set_offset",
-                        "valve_order",
-                        "wind_opened",
-                    ]
-                }
-                data[id_]["is_alive"] = r.is_alive()
+            snapshots = [r.snapshot for r in rooms.values()]
+            tag = etag(snapshots)
+            if request.headers.get("If-None-Match") == tag:
+                return HTTPResponse(status=304, ETag=tag)
+            response.set_header("ETag", tag)
+            response.content_type = "application/json"
+            return join_bodies(snapshots)
+
+        @mybottle.get("/api/rooms/<room_id>/events")
+        def api_room_events(room_id):
+            rooms = id_to_rooms(room_id)
+
+            def snapshots():
+                return [r.snapshot for r in id_to_rooms(room_id).values()]
+
+            try:
+                timeout = min(float(request.query.get("timeout") or 30), 300)
+                since = request.query.get("since")
+                if since is None:
+                    since = request.headers.get("Last-Event-ID")
+                    stream = True
+                else:
+                    stream = False
+                since = int(since or 0)
+            except ValueError as e:
+                abort(400, "Invalid parameter: {}".format(e))
+
+            if not stream:
+                # Long-poll: answer once a state is newer than `since`
+                acquire_stream()
                 try:
-                    data[id_]["sched_curr_mode"] = r.sched.current_mode()
-                except Exception as e:
-                    data[id_]["errors"].append(e)
-            return data
+                    found = wait_newer(snapshots, since, timeout)
+                finally:
+                    streams.release()
+                version = max((s.version for s in found), default=0)
+                response.content_type = "application/json"
+                return '{{"version": {}, "rooms": {}}}'.format(
+                    version, join_bodies(found)
+                )
+
+            # Server-Sent Events: one event per new room state
+            response.content_type = "text/event-stream"
+            response.set_header("Cache-Control", "no-cache")
+
+            def events():
+                last = since
+                try:
+                    while True:
+                        found = wait_newer(snapshots, last, 15)
+                        new = sorted(
+                            (s for s in found if s.version > last),
+                            key=lambda s: s.version,
+                        )
+                        if not new:
+                            yield ": keep-alive\n\n"
+                        for s in new:
+                            yield "id: {}\nevent: state\ndata: {}\n\n".format(
+                                s.version, s.body
+                            )
+                            last = s.version
+                finally:
+                    # Closed by the server once the client is gone
+                    streams.release()
+
+            if not rooms:
+                abort(404, "No room")
+            acquire_stream()
+            return events()
+
+        def controller_sync_batch(rooms, body):
+            """
+            Push per-room offsets and the circulator state in one request.
+            The deviations and the heat demand summary are computed from the
+            published snapshots.
+            """
+            offsets = {}
+            default = None
+            try:
+                for k, v in body.items():
+                    if k == "rooms":
+                        for id_, params in v.items():
+                            if id_ not in rooms:
+                                abort(404, 'Unknown room: "{}"'.format(id_))
+                            for name, value in params.items():
+                                if name != "temp_set_offset":
+                                    abort(400, 'Unknown key: "{}"'.format(name))
+                                offsets[id_] = float(value)
+                    elif k == "temp_set_offset":
+                        default = float(v)
+                    elif k == "circulator_runs":
+                        self.app.push_circulator_state(bool(v))
+                    else:
+                        abort(400, 'Unknown key: "{}"'.format(k))
+            except (AttributeError, TypeError, ValueError) as e:
+                abort(400, "Invalid parameter: {}".format(e))
+            if default is not None:
+                for id_ in rooms:
+                    offsets.setdefault(id_, default)
+            for id_, offset in offsets.items():
+                rooms[id_].push_temp_set_offset(offset)
+            deviations, summary = heat_demand(
+                [r.snapshot for r in rooms.values()], offsets
+            )
+            return {
+                "rooms": {id_: {"temp_deviation": d} for id_, d in deviations.items()},
+                "summary": summary,
+            }
 
         @mybottle.post("/api/rooms/<room_id>/controller_sync")
         def api_room_controller_sync(room_id):
             rooms = id_to_rooms(room_id)
+            if "rooms" in request.json:
+                return controller_sync_batch(rooms, request.json)
             data = {id_: {} for id_ in rooms}
             for k, v in request.json.items():
                 if k == "temp_set_offset":
                     for id_, r in rooms.items():
                         data[id_]["temp_deviation"] = r.temperature_deviation(float(v))
                 elif k == "circulator_runs":
-                    Room.push_circulator_state(bool(v))
+                    self.app.push_circulator_state(bool(v))
                 else:
                     abort('unknown key: "{}={}"'.format(k, v))
             return data
@@ -87,36 +203,72 @@ class API:
                 if k[0] != "_" and not isinstance(v, type(lambda: None))
             }
             for id_, r in rooms.items():
-                data[id_] = {k: v for k, v in vars(r).items() if k[0] != "_"}
-                data[id_]["is_alive"] = r.is_alive()
-                data[id_]["sched"] = {
-                    k: v for k, v in vars(r.sched).items() if k[0] != "_"
+                data[id_] = r.dump()
+            return data
+
+        @mybottle.get("/api/rooms/<room_id>/history")
+        def api_room_history(room_id):
+            rooms = id_to_rooms(room_id)
+            try:
+                params = {
+                    k: float(request.query[k]) if request.query.get(k) else None
+                    for k in ("from", "to", "step")
                 }
-                data[id_]["sched"]["next_schedule"] = r.sched.next_schedule()
-                data[id_]["sched"]["weekly_sched"] = r.sched.weekly_sched.jobs
+            except ValueError as e:
+                abort(400, "Invalid parameter: {}".format(e))
+            data = {}
+            for id_, r in rooms.items():
+                try:
+                    data[id_] = r.history_query(
+                        params["from"], params["to"], params["step"]
+                    )
+                except ValueError as e:
+                    abort(400, str(e))
             return data
 
-        @mybottle.get("/api/rooms/<room_id>/sched")
-        def api_room_sched(room_id):
+        @mybottle.get("/api/rooms/<room_id>/profile")
+        def api_room_profile(room_id):
+            rooms = id_to_rooms(room_id)
+            return {id_: r.profiler.stats() for id_, r in rooms.items()}
+
+        @mybottle.get("/api/rooms/<room_id>/profile/enable")
+        def api_room_profile_enable(room_id):
             rooms = id_to_rooms(room_id)
             data = {}
             for id_, r in rooms.items():
-                data[id_] = {
-                    k: v
-                    for k, v in vars(r.sched).items()
-                    if k
-                    in [
-                        "weekly_enabled",
-                        "weekly_scheduling",
-                        "onetime_sched",
-                        "temp_presets",
-                        "daily_presets",
-                        "hourly_presets",
-                    ]
-                }
-                data[id_]["next_schedule"] = r.sched.next_schedule()
+                r.profiler.enable()
+                data[id_] = {"enabled": r.profiler.enabled}
             return data
 
+        @mybottle.get("/api/rooms/<room_id>/profile/disable")
+        def api_room_profile_disable(room_id):
+            rooms = id_to_rooms(room_id)
+            data = {}
+            for id_, r in rooms.items():
+                r.profiler.disable()
+                data[id_] = {"enabled": r.profiler.enabled}
+            return data
+
+        @mybottle.get("/api/rooms/<room_id>/profile/cprofile")
+        def api_room_profile_cprofile(room_id):
+            rooms = id_to_rooms(room_id)
+            try:
+                ticks = int(request.query.get("ticks") or 10)
+            except ValueError as e:
+                abort(400, "Invalid parameter: {}".format(e))
+            if ticks < 1:
+                abort(400, "Invalid parameter: ticks must be positive")
+            data = {}
+            for id_, r in rooms.items():
+                r.profiler.request_cprofile(ticks)
+                data[id_] = {"cprofile_remaining": r.profiler.cprofile_remaining}
+            return data
+
+        @mybottle.get("/api/rooms/<room_id>/sched")
+        def api_room_sched(room_id):
+            rooms = id_to_rooms(room_id)
+            return {id_: r.sched.summary() for id_, r in rooms.items()}
+
         @mybottle.get("/api/rooms/<room_id>/sched/weekly/enable")
         def api_room_sched_weekly_enable(room_id):
             rooms = id_to_rooms(room_id)
@@ -140,6 +292,10 @@ class API:
             self.app.restart()
             return {"success": "For sure"}
 
+        @mybottle.get("/api/rooms/all/reload")
+        def api_room_reload():
+            return self.app.reload()
+
         @mybottle.get("/api/rooms/all/stop")
         def api_room_stop():
             for r in self.app.rooms.values():
@@ -166,4 +322,26 @@ class API:
         mybottle.install(
             JSONPlugin(json_dumps=lambda body: json.dumps(body, default=str))
         )
-        mybottle.run(host=self.addr, port=self.port, quiet=False)
+
+        def timed_app(environ, start_response):
+            # Observe the latency of the requests, with their final status
+            start = monotonic()
+            status = []
+
+            def timed_start_response(status_line, headers, exc_info=None):
+                status[:] = [status_line[:3]]
+                return start_response(status_line, headers, exc_info)
+
+            try:
+                return mybottle(environ, timed_start_response)
+            finally:
+                route = environ.get("bottle.route")
+                API_REQUEST.observe(
+                    monotonic() - start,
+                    environ["REQUEST_METHOD"],
+                    route.rule if route is not None else "",
+                    status[0] if status else "500",
+                )
+
+        server = make_server(self.server, self.addr, self.port, **self.server_options)
+        run(app=timed_app, server=server, host=self.addr, port=self.port, quiet=self.quiet)
@@ -1,14 +1,61 @@
+import logging
+import sys
 from configparser import ConfigParser
+from threading import RLock
 
 from okopilote.devices.common import devices
 from . import room
-from .api import API
+from .actuation import ActuatorHub, boards_from_file
+from .engine import RoomEngine
+from .loader import DeviceLoader
+from .persistence import Persister
+from .scheduler import ScheduleDispatcher
+from .sensors import SensorHub
+
+logger = logging.getLogger(__name__)
+
+ROOM_DEVICES = (
+    "temperature_sensor_device",
+    "humidity_sensor_device",
+    "radiator_valve_device",
+)
+
+
+def _room_devices(conf):
+    return {conf[k] for k in ROOM_DEVICES if conf.get(k)}
+
+
+def _device_deps(name, device_confs):
+    """
+    Return the device name and the names of the devices it refers to, like
+    its relay_device, recursively.
+    """
+    deps = set()
+    todo = [name]
+    while todo:
+        k = todo.pop()
+        if k in deps:
+            continue
+        deps.add(k)
+        todo += [v for v in device_confs.get(k, {}).values() if v in device_confs]
+    return deps
 
 
 class App:
     rooms = {}
     conf = None
     config_file = ""
+    engine = None
+    dispatcher = None
+    persister = None
+    actuators = None
+    sensors = None
+    loader = None
+    shards = None
+    room_ids = None  # Rooms of the shard run by a worker process, or all
+    reload_lock = RLock()  # Held by restarts and reloads
+    room_confs = {}
+    device_confs = {}
 
     @classmethod
     def _init_config(cls):
@@ -18,43 +65,311 @@ class App:
                 "common": {
                     "rooms_conf_file": "rooms.conf",
                     "devices_conf_file": "devices.conf",
+                    "engine": "threads",
+                    "engine_workers": "4",
+                    "processes": "1",
+                    "tick_stagger": "yes",
+                    "sensor_cache_ttl": "5.0",
+                    "sensor_read_timeout": "3.0",
+                    "sensor_read_workers": "4",
+                    "sensor_max_backoff": "300",
+                    "persistence_interval": "5.0",
+                    "valve_refresh_interval": "600",
+                    "valve_flush_delay": "0.5",
+                    "device_init_workers": "8",
+                    "device_init_timeout": "10",
                 },
                 "api": {
                     "listen_addr": "127.0.0.1",
                     "listen_port": "8882",
+                    "server": "threaded",
+                    "workers": "8",
+                    "request_timeout": "30",
+                    "keepalive_timeout": "5",
+                    "max_streams": "4",
+                    "quiet": "no",
                 },
             }
         )
         cls.conf.read_file(open(cls.config_file))
         devices.config_file(cls.conf["common"]["devices_conf_file"])
 
+    @classmethod
+    def _init_engine(cls):
+        mode = cls.conf["common"]["engine"]
+        if mode == "threads":
+            cls.engine = None
+        elif mode == "loop":
+            cls.engine = RoomEngine(workers=cls.conf["common"].getint("engine_workers"))
+        else:
+            raise ValueError('Unknown engine mode: "{}"'.format(mode))
+
+    @classmethod
+    def _read_confs(cls):
+        """
+        Return the config of each room and each device, by name.
+        """
+        rconf = room.read_conf(cls.conf["common"]["rooms_conf_file"])
+        dconf = ConfigParser()
+        dconf.read(cls.conf["common"]["devices_conf_file"])
+        return (
+            {
+                k: dict(rconf[k])
+                for k in rconf.sections()
+                if cls.room_ids is None or k in cls.room_ids
+            },
+            {k: dict(dconf[k]) for k in dconf.sections()},
+        )
+
     @classmethod
     def _init_rooms(cls, old_rooms=None):
-        cls.rooms = room.from_file(cls.conf["common"]["rooms_conf_file"])
-        for k, v in cls.rooms.items():
+        common = cls.conf["common"]
+        if cls.loader is None:
+            cls.loader = DeviceLoader(
+                devices.get_device, workers=common.getint("device_init_workers")
+            )
+        if cls.sensors is not None:
+            cls.sensors.stop()
+        cls.sensors = SensorHub(
+            ttl=common.getfloat("sensor_cache_ttl"),
+            timeout=common.getfloat("sensor_read_timeout"),
+            workers=common.getint("sensor_read_workers"),
+            max_backoff=common.getfloat("sensor_max_backoff"),
+            get_device=cls.loader.get_device,
+        )
+        if cls.dispatcher is None:
+            cls.dispatcher = ScheduleDispatcher()
+        if cls.persister is None:
+            cls.persister = Persister(interval=common.getfloat("persistence_interval"))
+        if cls.actuators is not None:
+            cls.actuators.stop()
+        cls.actuators = ActuatorHub(
+            refresh_interval=common.getfloat("valve_refresh_interval"),
+            flush_delay=common.getfloat("valve_flush_delay"),
+            boards=boards_from_file(common["devices_conf_file"]),
+            get_device=cls.loader.get_device,
+        )
+        cls.room_confs, cls.device_confs = cls._read_confs()
+        cls.loader.names = set(cls.device_confs)
+        rooms = cls._build_rooms(list(cls.room_confs), old_rooms)
+        cls._start_rooms(rooms)
+        cls.rooms = rooms
+
+    @classmethod
+    def _start_rooms(cls, rooms):
+        """
+        Start each room as soon as its devices, set up in the background, are
+        ready.
+        """
+        cls.loader.start_when_ready(
+            ((r, _room_devices(cls.room_confs[k])) for k, r in rooms.items()),
+            cls.conf["common"].getfloat("device_init_timeout"),
+        )
+
+    @classmethod
+    def _build_rooms(cls, room_ids, old_rooms):
+        rooms = room.from_file(
+            cls.conf["common"]["rooms_conf_file"],
+            engine=cls.engine,
+            sensors=cls.sensors,
+            dispatcher=cls.dispatcher,
+            persister=cls.persister,
+            actuators=cls.actuators,
+            room_ids=room_ids,
+            stagger=cls.conf["common"].getboolean("tick_stagger"),
+        )
+        for k, v in rooms.items():
             try:
                 v.temp_set = old_rooms[k].temp_set
             except (TypeError, KeyError):
                 pass
-            v.start()
+        return rooms
 
     @classmethod
-    def restart(cls):
+    def _init_shards(cls):
+        """
+        Run the rooms in worker processes, the rooms of this process being
+        proxies of them.
+        """
+        from .shard import Shards
+
+        common = cls.conf["common"]
+        cls.room_confs, cls.device_confs = cls._read_confs()
+        cls.shards = Shards(
+            cls.config_file,
+            cls.room_confs,
+            cls.device_confs,
+            boards_from_file(common["devices_conf_file"]),
+            common.getint("processes"),
+        )
+        cls.shards.start()
+        cls.rooms = cls.shards.rooms
+
+    @classmethod
+    def _init(cls):
+        cls._init_config()
+        processes = cls.conf["common"].getint("processes")
+        if processes > 1 and sys.version_info < (3, 8):
+            logger.warning(
+                "processes = {}: worker processes require Python 3.8 or later, "
+                "rooms are run in this process".format(processes)
+            )
+            processes = 1
+        if cls.room_ids is None and processes > 1:
+            cls._init_shards()
+        else:
+            cls._init_engine()
+            cls._init_rooms(cls.rooms)
+
+    @classmethod
+    def _retire_rooms(cls, rooms):
+        """
+        Stop the rooms, wait for their threads and close their history
+        stores, so that the rooms built in their place restore their latest
+        state and are the only writers of their history.
+        """
+        rooms = list(rooms)
+        for r in rooms:
+            r.stop()
+        for r in rooms:
+            if r.engine is None and r.is_alive():
+                r.join(r.period)
+            if r.history_store is not None:
+                r.history_store.close()
+
+    @classmethod
+    def _stop(cls):
+        """
+        Stop the rooms, or the worker processes, and the shared services.
+        """
+        if cls.shards is not None:
+            cls.shards.stop()
+            cls.shards = None
+            return
         for r in cls.rooms.values():
             r.stop()
+        if cls.engine is not None:
+            cls.engine.stop()
+        if cls.dispatcher is not None:
+            cls.dispatcher.stop()
+        if cls.persister is not None:
+            cls.persister.stop()
+        if cls.actuators is not None:
+            cls.actuators.stop()
+        if cls.sensors is not None:
+            cls.sensors.stop()
+
+    @classmethod
+    def push_circulator_state(cls, state):
+        room.Room.push_circulator_state(state)
+        if cls.shards is not None:
+            cls.shards.broadcast("push_circulator_state", state)
+
+    @classmethod
+    def restart(cls):
+        with cls.reload_lock:
+            if cls.shards is not None:
+                cls._stop()
+                cls._init()
+                return
+            cls._retire_rooms(cls.rooms.values())
+            if cls.engine is not None:
+                cls.engine.stop()
+            cls._init_config()
+            cls._init_engine()
+            cls._init_rooms(cls.rooms)
+
+    @classmethod
+    def reload(cls):
+        """
+        Apply the changes of the config files without a restart: only the
+        rooms whose config, or config of a device they use, has changed are
+        rebuilt, the others keep running with their samples. A change of the
+        common section falls back to a full restart. Return the room ids by
+        kind of change. Worker processes are restarted with all their rooms.
+        """
+        with cls.reload_lock:
+            return cls._reload()
+
+    @classmethod
+    def _reload(cls):
+        if cls.shards is not None:
+            cls.restart()
+            return {"added": [], "removed": [], "rebuilt": list(cls.rooms), "kept": []}
+        old_common = dict(cls.conf["common"])
+        old_rooms = cls.rooms
         cls._init_config()
-        cls._init_rooms(cls.rooms)
+        if dict(cls.conf["common"]) != old_common:
+            cls._retire_rooms(old_rooms.values())
+            if cls.engine is not None:
+                cls.engine.stop()
+            cls._init_engine()
+            cls._init_rooms(old_rooms)
+            return {"added": [], "removed": [], "rebuilt": list(cls.rooms), "kept": []}
+
+        room_confs, device_confs = cls._read_confs()
+        cls.loader.names = set(device_confs)
+        changed = {
+            k
+            for k in set(device_confs) | set(cls.device_confs)
+            if device_confs.get(k) != cls.device_confs.get(k)
+        }
+        # Devices using a changed device, like a valve and its relay
+        stale = {
+            k
+            for k in set(device_confs) | set(cls.device_confs)
+            if _device_deps(k, device_confs) & changed
+            or _device_deps(k, cls.device_confs) & changed
+        }
+        if stale:
+            cls.sensors.forget(stale)
+            cls.actuators.forget(
+                stale, boards=boards_from_file(cls.conf["common"]["devices_conf_file"])
+            )
+        removed = [k for k in old_rooms if k not in room_confs]
+        added = [k for k in room_confs if k not in old_rooms]
+        modified = [
+            k
+            for k in room_confs
+            if k in old_rooms
+            and (
+                room_confs[k] != cls.room_confs.get(k)
+                or _room_devices(room_confs[k]) & stale
+            )
+        ]
+        cls._retire_rooms(old_rooms[k] for k in removed + modified)
+        new = cls._build_rooms(added + modified, old_rooms)
+        cls.room_confs, cls.device_confs = room_confs, device_confs
+        cls._start_rooms(new)
+        rooms = {k: new.get(k) or old_rooms[k] for k in room_confs}
+        # Readers see either the old or the new registry
+        cls.rooms = rooms
+        kept = [k for k in room_confs if k not in new]
+        logger.info(
+            "reload: {} added, {} removed, {} rebuilt, {} kept".format(
+                len(added), len(removed), len(modified), len(kept)
+            )
+        )
+        return {"added": added, "removed": removed, "rebuilt": modified, "kept": kept}
 
     @classmethod
     def start(cls, config_file):
         cls.config_file = config_file
-        cls._init_config()
-        cls._init_rooms()
+        cls._init()
+        # Imported once the rooms run, bottle being long to import
+        from .api import API
+
+        api_conf = cls.conf["api"]
         myapi = API(
             cls,
-            addr=cls.conf["api"]["listen_addr"],
-            port=cls.conf["api"]["listen_port"],
+            addr=api_conf["listen_addr"],
+            port=api_conf["listen_port"],
+            server=api_conf["server"],
+            workers=api_conf.getint("workers"),
+            request_timeout=api_conf.getfloat("request_timeout"),
+            keepalive_timeout=api_conf.getfloat("keepalive_timeout"),
+            max_streams=api_conf.getint("max_streams"),
+            quiet=api_conf.getboolean("quiet"),
         )
         myapi.start()
-        for r in cls.rooms.values():
-            r.stop()
+        cls._stop()
@@ -0,0 +1,42 @@
+import time
+
+
+class SystemClock:
+    """
+    Clock of the system.
+    """
+
+    @staticmethod
+    def time():
+        return time.time()
+
+    @staticmethod
+    def monotonic():
+        return time.monotonic()
+
+
+class VirtualClock:
+    """
+    Clock that moves only when told to, so that the room logic can be run
+    faster than real time. Both clocks give the same virtual timestamp.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def set(self, timestamp):
+        if timestamp < self.now:
+            raise ValueError("The clock can not go back in time")
+        self.now = timestamp
+
+    def advance(self, seconds):
+        self.set(self.now + seconds)
+
+
+SYSTEM_CLOCK = SystemClock()
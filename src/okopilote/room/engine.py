@@ -0,0 +1,89 @@
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class RoomEngine:
+    """
+    Drive the acquisition loop of many rooms from a single scheduler thread.
+    Room steps, which mostly wait for device I/O, are run by a small pool of
+    worker threads.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.cond = Condition()
+        self.queue = []  # Heap of (deadline, sequence, room)
+        self.rooms = set()
+        self.seq = count()
+        self.pool = None
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        with self.cond:
+            if self.thread is not None:
+                return
+            self.stopped = False
+            self.pool = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="room-worker"
+            )
+            self.thread = Thread(target=self._loop, name="room-engine", daemon=True)
+            self.thread.start()
+        logger.debug("room engine started with {} workers".format(self.workers))
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.rooms.clear()
+            self.queue.clear()
+            self.cond.notify()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        self.thread = None
+        logger.debug("room engine stopped")
+
+    def add(self, room):
+        """
+        Schedule the room to be run on the deadlines of its ticker.
+        """
+        self.start()
+        with self.cond:
+            self.rooms.add(room)
+            self._push(room, room.ticker.next())
+
+    def remove(self, room):
+        with self.cond:
+            self.rooms.discard(room)
+            self.cond.notify()
+
+    def is_running(self, room):
+        return room in self.rooms
+
+    def _push(self, room, deadline):
+        heapq.heappush(self.queue, (deadline, next(self.seq), room))
+        self.cond.notify()
+
+    def _loop(self):
+        with self.cond:
+            while not self.stopped:
+                now = monotonic()
+                while self.queue and self.queue[0][0] <= now:
+                    deadline, _, room = heapq.heappop(self.queue)
+                    if room in self.rooms:
+                        self.pool.submit(self._run_room, room, deadline)
+                timeout = self.queue[0][0] - now if self.queue else None
+                self.cond.wait(timeout)
+
+    def _run_room(self, room, deadline):
+        alive = room._timed_tick(deadline)
+        with self.cond:
+            if not alive:
+                self.rooms.discard(room)
+            elif room in self.rooms and not self.stopped:
+                self._push(room, room.ticker.next())
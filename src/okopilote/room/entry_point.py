@@ -3,7 +3,6 @@ import argparse
 import logging
 
 from .__about__ import __version__
-from .app import App
 
 default_cf_file = "/etc/okopilote/room.conf"
 
@@ -27,6 +26,9 @@ def run():
     log_level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(level=log_level, format="[%(levelname)s] %(message)s")
 
+    # Imported after the arguments parsing, for a fast --help or --version
+    from .app import App
+
     try:
         App.start(config_file=args.conf)
     except FileNotFoundError as e:
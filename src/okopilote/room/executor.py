@@ -0,0 +1,57 @@
+from concurrent.futures import Executor, Future
+from queue import Queue
+from threading import Lock, Thread
+
+
+class DaemonExecutor(Executor):
+    """
+    Fixed pool of daemon threads, so that tasks left running, like event
+    streams or stuck device reads, do not prevent the process from exiting.
+    """
+
+    def __init__(self, workers, name="worker"):
+        self.queue = Queue()
+        self.lock = Lock()
+        self.stopped = False
+        self.threads = [
+            Thread(target=self._work, name="{}-{}".format(name, i), daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            future = Future()
+            self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True, **kwargs):
+        """
+        Let the threads exit once the queued tasks are done. A thread stuck in
+        a task exits when the task is over.
+        """
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            for thread in self.threads:
+                self.queue.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
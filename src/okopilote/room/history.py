@@ -0,0 +1,428 @@
+import logging
+import mmap
+import os
+import struct
+from array import array
+from math import isnan
+from threading import Lock, Thread
+from time import monotonic
+
+from .clock import SYSTEM_CLOCK
+
+logger = logging.getLogger(__name__)
+
+# Measures are stored in hundredths into signed 16 bits integers
+SCALE = 100.0
+MISSING = -32768
+# Name and array type of the columns, time being in seconds
+COLUMNS = (
+    ("temp", "h"),
+    ("humid", "h"),
+    ("temp_set", "h"),
+    ("temp_deviation", "h"),
+    ("valve_order", "b"),
+    ("wind_opened", "b"),
+)
+# Value kept by the compaction for each array type: the integer columns are
+# states, whose mean would be truncated
+AGGREGATES = {"h": "mean", "b": "max"}
+# Record of the on-disk history: little-endian time then the columns
+RECORD = struct.Struct("<I" + "".join(typecode for _, typecode in COLUMNS))
+
+
+def _encode(value, typecode):
+    if value is None:
+        return MISSING if typecode == "h" else -1
+    if typecode == "h":
+        if isnan(value):
+            return MISSING
+        return max(MISSING + 1, min(32767, int(round(value * SCALE))))
+    return int(value)
+
+
+def encode_row(values):
+    """
+    Return the stored values, in the order of COLUMNS, of a dict of values.
+    """
+    return [_encode(values.get(name), typecode) for name, typecode in COLUMNS]
+
+
+def _decode(value, typecode):
+    if typecode == "h":
+        return None if value == MISSING else value / SCALE
+    return None if value < 0 else value
+
+
+def decode_row(row):
+    """
+    Return the time and the dict of values of a stored record.
+    """
+    return row[0], {
+        name: _decode(value, typecode)
+        for (name, typecode), value in zip(COLUMNS, row[1:])
+    }
+
+
+class History:
+    """
+    Fixed size ring buffer of the room states, one row per tick, stored in
+    typed columns so that no Python object is kept per row (14 bytes per row).
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("History size must be at least 1: {}".format(size))
+        self.size = size
+        self.lock = Lock()
+        self.pos = 0
+        self.length = 0
+        self.times = array("I", [0]) * size
+        self.columns = {name: array(typecode, [0]) * size for name, typecode in COLUMNS}
+
+    def __len__(self):
+        return self.length
+
+    def append(self, timestamp, **values):
+        """
+        Record a row. Missing values are given as None.
+        """
+        with self.lock:
+            pos = self.pos
+            self.times[pos] = int(timestamp)
+            for (name, _), x in zip(COLUMNS, encode_row(values)):
+                self.columns[name][pos] = x
+            self.pos = (pos + 1) % self.size
+            if self.length < self.size:
+                self.length += 1
+
+    def _bisect(self, timestamp):
+        """
+        Return the logical index of the first row at or after the timestamp.
+        """
+        start = (self.pos - self.length) % self.size
+        lo, hi = 0, self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[(start + mid) % self.size] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def rows(self, from_=None, to=None):
+        """
+        Return the times and columns (as arrays of stored values) of the rows
+        between the two timestamps, both included.
+        """
+        with self.lock:
+            first = 0 if from_ is None else self._bisect(from_)
+            last = self.length if to is None else self._bisect(int(to) + 1)
+            i = (self.pos - self.length + first) % self.size
+            j = i + last - first
+            if j <= self.size:
+
+                def cut(a):
+                    return a[i:j]
+
+            else:
+
+                def cut(a):
+                    return a[i:] + a[: j - self.size]
+
+            return cut(self.times), {n: cut(a) for n, a in self.columns.items()}
+
+    def oldest(self):
+        """
+        Return the timestamp of the oldest row, or None if empty.
+        """
+        with self.lock:
+            if not self.length:
+                return None
+            return self.times[(self.pos - self.length) % self.size]
+
+    def query(self, from_=None, to=None, step=None, max_buckets=10000):
+        """
+        Return the min, mean and max values of every column over buckets of
+        `step` seconds between the two timestamps.
+        """
+        times, columns = self.rows(from_, to)
+        if not times:
+            return {"step": step, "buckets": []}
+        if from_ is None:
+            from_ = times[0]
+        if to is None:
+            to = times[-1]
+        step = check_step(from_, to, step, max_buckets)
+        rows = zip(times, *(columns[name] for name, _ in COLUMNS))
+        return {"step": step, "buckets": bucketize(rows, from_, step)}
+
+
+def check_step(from_, to, step, max_buckets):
+    if not step or step <= 0:
+        step = max(1, (to - from_ + 1) / 120)
+    if (to - from_) / step >= max_buckets:
+        raise ValueError("Too many buckets, increase the step")
+    return step
+
+
+def bucketize(rows, from_, step):
+    """
+    Aggregate rows of stored values, given as (time, value1, value2...) in
+    the order of COLUMNS, into buckets of `step` seconds.
+    """
+    buckets = []
+    index, acc = None, None
+    for row in rows:
+        i = int((row[0] - from_) // step)
+        if i != index:
+            if acc is not None:
+                buckets.append(_bucket(from_ + index * step, acc))
+            index, acc = i, [0] + [[None, None, 0, 0] for _ in COLUMNS]
+        acc[0] += 1
+        for a, x, (name, typecode) in zip(acc[1:], row[1:], COLUMNS):
+            v = _decode(x, typecode)
+            if v is not None:
+                if a[3] == 0 or v < a[0]:
+                    a[0] = v
+                if a[3] == 0 or v > a[1]:
+                    a[1] = v
+                a[2] += v
+                a[3] += 1
+    if acc is not None:
+        buckets.append(_bucket(from_ + index * step, acc))
+    return buckets
+
+
+def _bucket(time_, acc):
+    bucket = {"time": time_, "samples": acc[0]}
+    for (name, _), (mini, maxi, sum_, count) in zip(COLUMNS, acc[1:]):
+        if count:
+            bucket[name] = {
+                "min": mini,
+                "mean": round(sum_ / count, 2),
+                "max": maxi,
+            }
+        else:
+            bucket[name] = None
+    return bucket
+
+
+class HistoryStore:
+    """
+    Durable history of a room: an append-only log of fixed size records,
+    split into time segments and read back through mmap. Segments older than
+    `compact_after` seconds are downsampled to one record per `compact_step`
+    seconds by a background thread. Compacted records hold the mean of the
+    measures and the max of the valve orders and window states, so that a
+    valve opened or a window detected during a step is kept.
+
+    Segment files are named "<start time>-<step>.bin", step being 0 for
+    segments holding raw records.
+    """
+
+    def __init__(
+        self,
+        directory,
+        segment_duration=86400,
+        compact_after=604800,
+        compact_step=600,
+        flush_interval=60.0,
+        clock=None,
+    ):
+        self.directory = directory
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.segment_duration = int(segment_duration)
+        self.compact_after = compact_after
+        self.compact_step = int(compact_step)
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.file = None
+        self.segment_end = 0
+        self.last_flush = 0.0
+        self.compacting = None
+        self.compact_lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _segments(self):
+        """
+        Return the sorted list of (start, step, path) of the segments.
+        """
+        segments = []
+        for name in os.listdir(self.directory):
+            root, ext = os.path.splitext(name)
+            try:
+                start, step = (int(x) for x in root.split("-"))
+            except ValueError:
+                continue
+            if ext == ".bin":
+                segments.append((start, step, os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def _read(self, start, step, path, from_=None, to=None):
+        """
+        Yield the records of a listed segment, from its compacted copy if it
+        has been compacted since, or none if it has been removed.
+        """
+        try:
+            yield from _read_segment(path, from_, to)
+        except FileNotFoundError:
+            if step:
+                return
+            path = os.path.join(
+                self.directory, "{}-{}.bin".format(start, self.compact_step)
+            )
+            try:
+                yield from _read_segment(path, from_, to)
+            except FileNotFoundError:
+                pass
+
+    def append(self, timestamp, **values):
+        """
+        Record a row. Missing values are given as None.
+        """
+        t = int(timestamp)
+        record = RECORD.pack(t, *encode_row(values))
+        with self.lock:
+            if self.file is None or t >= self.segment_end:
+                self._rotate(t)
+            self.file.write(record)
+            if monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def _rotate(self, t):
+        if self.file is not None:
+            self.file.close()
+        start = t - t % self.segment_duration
+        path = os.path.join(self.directory, "{}-0.bin".format(start))
+        self.file = open(path, "ab")
+        # Drop a partial record left by a crash, which would shift the
+        # records appended after it
+        size = self.file.tell()
+        if size % RECORD.size:
+            logger.warning(
+                'history: segment "{}": {} bytes of a partial record '
+                "dropped".format(path, size % RECORD.size)
+            )
+            self.file.truncate(size - size % RECORD.size)
+        self.segment_end = start + self.segment_duration
+        self.last_flush = monotonic()
+        logger.debug('history: write to segment "{}"'.format(path))
+        self.compact_in_background()
+
+    def _flush(self):
+        if self.file is not None:
+            self.file.flush()
+        self.last_flush = monotonic()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def rows(self, from_=None, to=None):
+        """
+        Yield the records, as (time, value1, value2...) tuples, between the
+        two timestamps, both included.
+        """
+        self.flush()
+        # A segment being compacted is listed twice, keep its compacted copy
+        segments = {
+            start: (start, step, path) for start, step, path in self._segments()
+        }
+        for start, step, path in sorted(segments.values()):
+            if to is not None and start > to:
+                break
+            if from_ is not None and start + self.segment_duration <= from_:
+                continue
+            for row in self._read(start, step, path, from_, to):
+                yield row
+
+    def oldest(self):
+        for start, step, path in self._segments():
+            for row in self._read(start, step, path):
+                return row[0]
+        return None
+
+    def query(self, from_=None, to=None, step=None, max_buckets=10000):
+        """
+        Return the min, mean and max values of every column over buckets of
+        `step` seconds between the two timestamps.
+        """
+        if from_ is None:
+            from_ = self.oldest()
+            if from_ is None:
+                return {"step": step, "buckets": []}
+        if to is None:
+            to = self.clock.time()
+        step = check_step(from_, to, step, max_buckets)
+        return {"step": step, "buckets": bucketize(self.rows(from_, to), from_, step)}
+
+    def compact_in_background(self):
+        if self.compacting is None or not self.compacting.is_alive():
+            self.compacting = Thread(
+                target=self.compact, name="history-compaction", daemon=True
+            )
+            self.compacting.start()
+
+    def compact(self, now=None):
+        """
+        Downsample the raw segments older than `compact_after` seconds.
+        """
+        if now is None:
+            now = self.clock.time()
+        with self.compact_lock:
+            self._compact(now)
+
+    def _compact(self, now):
+        for start, step, path in self._segments():
+            if step or start + self.segment_duration > now - self.compact_after:
+                continue
+            dest = os.path.join(
+                self.directory, "{}-{}.bin".format(start, self.compact_step)
+            )
+            try:
+                buckets = bucketize(_read_segment(path), start, self.compact_step)
+                with open(dest + ".tmp", "wb") as f:
+                    for b in buckets:
+                        values = {
+                            name: b[name][AGGREGATES[typecode]] if b[name] else None
+                            for name, typecode in COLUMNS
+                        }
+                        f.write(RECORD.pack(int(b["time"]), *encode_row(values)))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(dest + ".tmp", dest)
+                os.remove(path)
+                logger.debug('history: segment "{}" compacted'.format(path))
+            except (OSError, ValueError) as e:
+                logger.error('history: failed to compact "{}": {}'.format(path, e))
+
+
+def _read_segment(path, from_=None, to=None):
+    """
+    Yield the records of a segment file between the two timestamps, the first
+    one being located by bisection on the mapped file.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size // RECORD.size * RECORD.size
+        if not size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            lo, hi = 0, size // RECORD.size
+            if from_ is not None:
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if RECORD.unpack_from(m, mid * RECORD.size)[0] < from_:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+            for offset in range(lo * RECORD.size, size, RECORD.size):
+                row = RECORD.unpack_from(m, offset)
+                if to is not None and row[0] > to:
+                    break
+                yield row
@@ -0,0 +1,128 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, wait
+from threading import Lock
+from time import monotonic
+
+from .executor import DaemonExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class PendingDevice:
+    """
+    Device being created in the background. Its attributes are the ones of
+    the device once created; before, or if the creation failed, accessing
+    them raises OSError, like a device read failure.
+    """
+
+    def __init__(self, name, future):
+        self.name = name
+        self.future = future
+        self.device = None
+
+    def ready(self):
+        """
+        Return the device if it has been created, None otherwise.
+        """
+        try:
+            return self._device()
+        except OSError:
+            return None
+
+    def _device(self):
+        device = self.device
+        if device is None:
+            if not self.future.done():
+                raise OSError('Device "{}" is not ready yet'.format(self.name))
+            try:
+                device = self.future.result()
+            except Exception as e:
+                raise OSError('Failed to set up device "{}": {}'.format(self.name, e))
+            if device is None:
+                raise OSError('Unknown device "{}"'.format(self.name))
+            self.device = device
+        return device
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            # Not a device attribute, like the ones probed by copy
+            raise AttributeError(attr)
+        return getattr(self._device(), attr)
+
+
+class DeviceLoader:
+    """
+    Factory of the devices that creates them concurrently in the background,
+    so that a slow device module import or hardware probe does not delay the
+    other devices. `get_device` returns a PendingDevice at once, to be given
+    to the sensor and actuator hubs, or None for a name missing from the
+    configured device names, like the devices library does.
+    """
+
+    def __init__(self, get_device, workers=8, names=None):
+        self.create = get_device
+        self.executor = DaemonExecutor(workers, name="device-loader")
+        self.lock = Lock()
+        self.futures = {}
+        self.names = names  # Names of the configured devices, any if None
+
+    def _create(self, name):
+        start = monotonic()
+        try:
+            device = self.create(name)
+        except Exception as e:
+            logger.error('Failed to set up device "{}": {}'.format(name, e))
+            raise
+        logger.debug('device "{}": set up in {:.3f}s'.format(name, monotonic() - start))
+        return device
+
+    def get_device(self, name):
+        names = self.names
+        if names is not None and name not in names:
+            logger.warning('Unknown device "{}", ignored'.format(name))
+            return None
+        future = self.executor.submit(self._create, name)
+        with self.lock:
+            self.futures[name] = future
+        return PendingDevice(name, future)
+
+    def pending(self, names):
+        """
+        Return the futures of the devices of the names still being created.
+        """
+        with self.lock:
+            futures = [self.futures.get(name) for name in names]
+        return {f for f in futures if f is not None and not f.done()}
+
+    def start_when_ready(self, items, timeout):
+        """
+        Start each item of the (object, device names) pairs, like rooms, as
+        soon as its devices are created. Items whose devices are still not
+        ready after timeout seconds are started anyway.
+        """
+        deadline = monotonic() + timeout
+        waiting = list(items)
+        while waiting:
+            left = []
+            for obj, names in waiting:
+                pending = self.pending(names)
+                if pending:
+                    left.append((obj, names, pending))
+                else:
+                    obj.start()
+            remaining = deadline - monotonic()
+            if left and remaining <= 0:
+                for obj, names, pending in left:
+                    logger.warning(
+                        '"{}": devices still not ready after {}s, started '
+                        "anyway".format(obj.name, timeout)
+                    )
+                    obj.start()
+                return
+            if left:
+                wait(
+                    set().union(*(p for _, _, p in left)),
+                    timeout=remaining,
+                    return_when=FIRST_COMPLETED,
+                )
+            waiting = [(obj, names) for obj, names, _ in left]
@@ -0,0 +1,224 @@
+from bisect import bisect_left
+from threading import Lock
+from time import monotonic
+
+# Upper bounds in seconds of the latency histograms buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    return "{{{}}}".format(",".join(pairs)) if pairs else ""
+
+
+class Metric:
+    """
+    Values of a metric by tuple of label values.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.values = {}
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+            values = [(k, list(v) if isinstance(v, list) else v) for k, v in values]
+        for labels, value in values:
+            lines += self._render_value(labels, value)
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def _render_value(self, labels, value):
+        return ["{}{} {}".format(self.name, _format_labels(self.labels, labels), value)]
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed buckets: observing a value costs a bisection and
+    two additions.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            try:
+                counts = self.values[labels]
+            except KeyError:
+                # One count per bucket, the +Inf count and the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        """
+        Return a context manager observing the duration of its block.
+        """
+        return _Timer(self, labels)
+
+    def _render_value(self, labels, counts):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            total += count
+            lines.append(
+                "{}_bucket{} {}".format(
+                    self.name, _format_labels(self.labels, labels, ("le", bound)), total
+                )
+            )
+        label_str = _format_labels(self.labels, labels)
+        lines.append("{}_sum{} {}".format(self.name, label_str, counts[-1]))
+        lines.append("{}_count{} {}".format(self.name, label_str, total))
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(monotonic() - self.start, *self.labels)
+
+
+class TimedLock:
+    """
+    Lock recording in a histogram the time waited to acquire it.
+    """
+
+    def __init__(self, histogram, *labels):
+        self.lock = Lock()
+        self.histogram = histogram
+        self.labels = labels
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = monotonic()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.histogram.observe(monotonic() - start, *self.labels)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Registry:
+    """
+    Set of metrics rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+ROOM_TICK = REGISTRY.histogram(
+    "okopilote_room_tick_seconds", "Duration of the room ticks.", ("room",)
+)
+SENSOR_READ = REGISTRY.histogram(
+    "okopilote_room_sensor_read_seconds",
+    "Duration of the sensor device reads.",
+    ("sensor",),
+)
+SENSOR_FAILURES = REGISTRY.counter(
+    "okopilote_room_sensor_failures_total",
+    "Failed sensor reads, by reason: error or timeout.",
+    ("sensor", "reason"),
+)
+VALVE_COMMANDS = REGISTRY.counter(
+    "okopilote_room_valve_commands_total",
+    "Orders written to the valve devices.",
+    ("valve", "order"),
+)
+VALVE_FAILURES = REGISTRY.counter(
+    "okopilote_room_valve_failures_total",
+    "Orders that failed to be written to the valve devices.",
+    ("valve", "order"),
+)
+SCHEDULER_LOCK_WAIT = REGISTRY.histogram(
+    "okopilote_room_scheduler_lock_wait_seconds",
+    "Time waited to acquire the lock of the room schedulers.",
+    ("room",),
+)
+PERSISTENCE_WRITE = REGISTRY.histogram(
+    "okopilote_room_persistence_write_seconds", "Duration of the data file writes."
+)
+PERSISTENCE_FAILURES = REGISTRY.counter(
+    "okopilote_room_persistence_failures_total", "Failed data file writes."
+)
+API_REQUEST = REGISTRY.histogram(
+    "okopilote_room_api_request_seconds",
+    "Duration of the API requests, by route.",
+    ("method", "route", "status"),
+)
@@ -0,0 +1,108 @@
+import logging
+import os
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+from .metrics import PERSISTENCE_FAILURES, PERSISTENCE_WRITE
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(path, data):
+    """
+    Write the string to the file so that the file is either the old or the
+    new version, even on a crash: write to a temporary file, sync it and
+    rename it over the destination.
+    """
+    tmp = "{}.tmp".format(path)
+    start = monotonic()
+    try:
+        with open(tmp, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except OSError:
+        PERSISTENCE_FAILURES.inc()
+        raise
+    PERSISTENCE_WRITE.observe(monotonic() - start)
+
+
+class Persister:
+    """
+    Write-behind persistence with a single writer thread. Writes requested
+    for a file during the coalescing interval are merged into one write of
+    the last requested content, so callers never wait for the disk.
+    """
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.cond = Condition()
+        self.write_lock = Lock()
+        self.pending = {}  # Path -> (content, error callback)
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        with self.cond:
+            if self.thread is not None:
+                return
+            self.stopped = False
+            self.thread = Thread(target=self._loop, name="persister", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stop the writer thread after having written the pending contents.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.flush()
+        self.thread = None
+
+    def write(self, path, data, on_error=None):
+        """
+        Request the string to be written to the file. `on_error` is called
+        with the exception if the write fails.
+        """
+        self.start()
+        with self.cond:
+            self.pending[path] = (data, on_error)
+            self.cond.notify()
+
+    def flush(self):
+        """
+        Write the pending contents now, in the calling thread.
+        """
+        with self.write_lock:
+            with self.cond:
+                pending, self.pending = self.pending, {}
+            self._write(pending)
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                # Let a burst of edits coalesce until the deadline, as the
+                # notifications of the writes wake up the wait
+                deadline = monotonic() + self.interval
+                remaining = self.interval
+                while remaining > 0 and not self.stopped:
+                    self.cond.wait(remaining)
+                    remaining = deadline - monotonic()
+            self.flush()
+
+    def _write(self, pending):
+        # Called with the write lock held, so that contents taken from
+        # pending are written in the order they were requested
+        for path, (data, on_error) in pending.items():
+            try:
+                write_atomic(path, data)
+            except OSError as e:
+                logger.error('Failed to write to "{}": {}'.format(path, e))
+                if on_error is not None:
+                    on_error(e)
@@ -0,0 +1,134 @@
+import cProfile
+import logging
+import os
+from collections import deque
+from threading import Lock
+from time import monotonic, strftime
+
+logger = logging.getLogger(__name__)
+
+
+def _noop(stage):
+    pass
+
+
+class StageProfiler:
+    """
+    Rolling timings of the stages of the ticks of a room, and cProfile dumps
+    of a number of ticks to the data directory.
+
+    While disabled, `start` returns a function doing nothing, so that the
+    stage marks of the ticks cost a call.
+    """
+
+    def __init__(self, name, directory, size=100):
+        self.name = name
+        self.directory = directory
+        self.size = size
+        self.enabled = False
+        self.lock = Lock()
+        self.timings = {}  # Stage -> deque of durations
+        self.ticks = 0
+        self.cprofile = None
+        self.cprofile_remaining = 0
+        self.cprofile_file = None
+
+    def enable(self):
+        with self.lock:
+            self.enabled = True
+
+    def disable(self):
+        with self.lock:
+            self.enabled = False
+            self.timings = {}
+            self.ticks = 0
+
+    def start(self):
+        """
+        Start timing a tick. Return the function to call with the name of
+        each stage at its end.
+        """
+        if not self.enabled:
+            return _noop
+        last = [monotonic()]
+        timings = self.timings
+        size = self.size
+        self.ticks += 1
+
+        def lap(stage):
+            now = monotonic()
+            try:
+                timings[stage].append(now - last[0])
+            except KeyError:
+                timings[stage] = deque([now - last[0]], size)
+            last[0] = now
+
+        return lap
+
+    def stats(self):
+        """
+        Return the last, mean and max duration of each stage.
+        """
+        with self.lock:
+            timings = {k: list(v) for k, v in self.timings.items()}
+        return {
+            "enabled": self.enabled,
+            "ticks": self.ticks,
+            "stages": {
+                k: {
+                    "count": len(v),
+                    "last": round(v[-1], 6),
+                    "mean": round(sum(v) / len(v), 6),
+                    "max": round(max(v), 6),
+                }
+                for k, v in timings.items()
+            },
+            "cprofile_remaining": self.cprofile_remaining,
+            "cprofile_file": self.cprofile_file,
+        }
+
+    def request_cprofile(self, ticks):
+        """
+        Profile the next ticks with cProfile, then dump the stats to the
+        data directory.
+        """
+        with self.lock:
+            self.cprofile = cProfile.Profile()
+            self.cprofile_remaining = ticks
+
+    def run(self, func):
+        """
+        Run the tick function, under cProfile if requested.
+        """
+        if not self.cprofile_remaining:
+            return func()
+        profile = self.cprofile
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active, like the one of another room
+            return func()
+        try:
+            return func()
+        finally:
+            profile.disable()
+            with self.lock:
+                self.cprofile_remaining -= 1
+                if not self.cprofile_remaining:
+                    self._dump(profile)
+
+    def _dump(self, profile):
+        path = os.path.join(
+            self.directory,
+            "profile",
+            "{}-{}.prof".format(self.name, strftime("%Y%m%d-%H%M%S")),
+        )
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            profile.dump_stats(path)
+        except OSError as e:
+            logger.error('Failed to write profile to "{}": {}'.format(path, e))
+            return
+        self.cprofile = None
+        self.cprofile_file = path
+        logger.info('room "{}": profile written to "{}"'.format(self.name, path))
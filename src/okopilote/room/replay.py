@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Replay of recorded sensor traces through the room logic, on a virtual clock
+and as fast as the CPU allows. The valve orders, window detections and
+setpoint changes of the rooms are written as events.
+
+Traces are either a CSV file with a header holding the columns time (epoch
+seconds or ISO 8601), room, temperature and optionally humidity, or a
+history directory: data_dir/history with a sub-directory per room, or the
+directory of one room.
+"""
+
+import argparse
+import csv
+import heapq
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+from math import ceil
+from time import monotonic
+
+from . import room
+from .actuation import ActuatorHub
+from .clock import VirtualClock
+from .history import HistoryStore, decode_row
+from .sensors import SensorHub
+
+logger = logging.getLogger(__name__)
+
+VALVE_ORDERS = {
+    room.Room.VALVE_CLOSE: "close",
+    room.Room.VALVE_OPEN: "open",
+    room.Room.VALVE_RELEASE: "release",
+}
+
+
+class TraceSensor:
+    """
+    Sensor returning the last measures fed from a trace, while they are not
+    older than `max_age` seconds.
+    """
+
+    def __init__(self, clock, max_age=300.0):
+        self.clock = clock
+        self.max_age = max_age
+        self.time = None
+        self.temp = None
+        self.humid = None
+
+    def update(self, timestamp, temp, humid):
+        self.time = timestamp
+        self.temp = temp
+        self.humid = humid
+
+    def _fresh(self, value):
+        if (
+            value is None
+            or self.time is None
+            or self.clock.time() - self.time > self.max_age
+        ):
+            raise OSError("No measure in the trace")
+        return value
+
+    @property
+    def temperature(self):
+        return self._fresh(self.temp)
+
+    @property
+    def humidity(self):
+        return self._fresh(self.humid)
+
+    @property
+    def temperature_humidity(self):
+        return (self._fresh(self.temp), self.humid)
+
+
+class NullPersister:
+    """
+    Persister dropping the writes, so that a replay leaves data files as is.
+    """
+
+    def write(self, path, data, on_error=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def _float(value):
+    return float(value) if value not in (None, "") else None
+
+
+def _timestamp(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def read_csv(path):
+    """
+    Yield the (time, room id, temperature, humidity) samples of a CSV file.
+    """
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            yield (
+                _timestamp(row["time"]),
+                row["room"],
+                _float(row.get("temperature")),
+                _float(row.get("humidity")),
+            )
+
+
+def _read_store(directory, room_id):
+    for row in HistoryStore(directory).rows():
+        t, values = decode_row(row)
+        yield (t, room_id, values["temp"], values["humid"])
+
+
+def read_history(directory):
+    """
+    Yield the (time, room id, temperature, humidity) samples of a history
+    directory, merged by time.
+    """
+    if any(name.endswith(".bin") for name in os.listdir(directory)):
+        stores = {os.path.basename(os.path.normpath(directory)): directory}
+    else:
+        stores = {
+            name: os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if os.path.isdir(os.path.join(directory, name))
+        }
+    return heapq.merge(
+        *(_read_store(path, room_id) for room_id, path in stores.items()),
+        key=lambda sample: sample[0],
+    )
+
+
+def read_trace(path):
+    if os.path.isdir(path):
+        return read_history(path)
+    return read_csv(path)
+
+
+class Replay:
+    """
+    Run rooms on a virtual clock, each at its period, feeding their sensors
+    from a trace of samples sorted by time.
+    """
+
+    def __init__(self, rooms, clock, max_age=300.0, circulator=True):
+        self.rooms = rooms
+        self.clock = clock
+        self.circulator = circulator
+        self.ticks = 0
+        self.sensors = {}
+        for id_, r in rooms.items():
+            sensor = TraceSensor(clock, max_age)
+            self.sensors[id_] = sensor
+            r.temp_sensor = r.humid_sensor = sensor
+            r.valve = None
+
+    def run(self, samples):
+        """
+        Feed the samples and tick the rooms until the end of the trace, a
+        room from its first sample on. Yield the (time, room id, name, value)
+        events, name being valve_order, wind_opened or temp_set.
+        """
+        samples = iter(samples)
+        sample = next(samples, None)
+        if sample is None:
+            return
+        end = sample[0]
+        heap = []
+        last = {}
+        for i, (id_, r) in enumerate(sorted(self.rooms.items())):
+            heap.append((ceil(sample[0] / r.period) * r.period, i, r))
+            last[id_] = (None, None, None)
+        heapq.heapify(heap)
+        while heap:
+            t, i, r = heap[0]
+            while sample is not None and sample[0] <= t:
+                end = sample[0]
+                try:
+                    self.sensors[sample[1]].update(sample[0], *sample[2:])
+                except KeyError:
+                    pass
+                sample = next(samples, None)
+            if sample is None and t > end:
+                break
+            heapq.heappop(heap)
+            if self.sensors[r.room_id].time is None:
+                heapq.heappush(heap, (t + r.period, i, r))
+                continue
+            self.clock.set(t)
+            if self.circulator:
+                r.circulator_runs_pushed = (True, t)
+            alive = r._tick()
+            self.ticks += 1
+            state = (r.valve_order, r.wind_opened, r.temp_set)
+            for name, old, new in zip(
+                ("valve_order", "wind_opened", "temp_set"), last[r.room_id], state
+            ):
+                if new != old:
+                    if name == "valve_order":
+                        new = VALVE_ORDERS.get(new)
+                    yield (t, r.room_id, name, new)
+            last[r.room_id] = state
+            if alive:
+                heapq.heappush(heap, (t + r.period, i, r))
+
+
+def replay(rooms_conf_file, trace, max_age=300.0, circulator=True, overrides=None):
+    """
+    Return the Replay of the rooms of the config file and the iterator of
+    its events, the clock starting at the first sample of the trace.
+    """
+    samples = iter(trace)
+    first = next(samples, None)
+    clock = VirtualClock(first[0] if first is not None else 0.0)
+    rooms = room.from_file(
+        rooms_conf_file,
+        sensors=SensorHub(ttl=0, timeout=0, get_device=lambda name: None),
+        actuators=ActuatorHub(get_device=lambda name: None),
+        persister=NullPersister(),
+        clock=clock,
+        overrides=dict(
+            overrides or {},
+            history_store="no",
+            state_snapshot_interval="0",
+            state_max_age="0",
+        ),
+    )
+    player = Replay(rooms, clock, max_age=max_age, circulator=circulator)
+    if first is None:
+        return player, iter(())
+    return player, player.run(_chain(first, samples))
+
+
+def _chain(first, samples):
+    yield first
+    yield from samples
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("trace", help="CSV file or history directory")
+    parser.add_argument(
+        "-r", "--rooms-conf", required=True, help="Rooms configuration file"
+    )
+    parser.add_argument(
+        "-s",
+        "--set",
+        action="append",
+        default=[],
+        metavar="OPTION=VALUE",
+        help="Override a room option, like window_threshold=0.3",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=300.0,
+        help="Seconds a sample is used by the rooms. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--no-circulator",
+        action="store_true",
+        help="Replay with the circulator stopped, valves being released",
+    )
+    parser.add_argument("--format", choices=("csv", "json"), default="csv")
+    parser.add_argument("-o", "--output", help="Events file. Default: stdout")
+    parser.add_argument(
+        "-v", "--verbose", help="increase verbosity", action="store_true"
+    )
+    args = parser.parse_args()
+
+    log_level = logging.DEBUG if args.verbose else logging.WARNING
+    logging.basicConfig(level=log_level, format="[%(levelname)s] %(message)s")
+    try:
+        overrides = dict(s.split("=", 1) for s in args.set)
+    except ValueError:
+        parser.error("Overrides must be like OPTION=VALUE")
+
+    start = monotonic()
+    try:
+        player, events = replay(
+            args.rooms_conf,
+            read_trace(args.trace),
+            max_age=args.max_age,
+            circulator=not args.no_circulator,
+            overrides=overrides,
+        )
+        out = open(args.output, "w", newline="") if args.output else sys.stdout
+        try:
+            first = None
+            if args.format == "csv":
+                writer = csv.writer(out)
+                writer.writerow(("time", "room", "event", "value"))
+            for event in events:
+                first = event[0] if first is None else first
+                if args.format == "csv":
+                    writer.writerow(event)
+                else:
+                    out.write(
+                        json.dumps(dict(zip(("time", "room", "event", "value"), event)))
+                        + "\n"
+                    )
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    except (OSError, KeyError, ValueError) as e:
+        logging.error(e)
+        exit(1)
+    elapsed = monotonic() - start
+    span = (player.clock.now - first) if first is not None else 0.0
+    logging.getLogger().setLevel(logging.INFO)
+    logger.info(
+        "{} ticks of {} rooms over {:.1f} days replayed in {:.1f}s".format(
+            player.ticks, len(player.rooms), span / 86400, elapsed
+        )
+    )
+
+
+if __name__ == "__main__":
+    run()
@@ -1,20 +1,31 @@
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 import json
 import logging
+import os
 from configparser import ConfigParser
 from math import isnan
 from threading import Thread, Event, Lock
-from time import time
-from collections import deque
-
-from okopilote.devices.common import devices
+from time import monotonic
 
+from .actuation import ActuatorHub
+from .clock import SYSTEM_CLOCK
 from .scheduler import TemperatureScheduler
+from .history import History, HistoryStore
+from .metrics import ROOM_TICK
+from .persistence import write_atomic
+from .profiler import StageProfiler
+from .sensors import SensorHub, read_later
+from .snapshot import RoomSnapshot
+from .stats import RollingSample
+from .ticker import Ticker
 
 logger = logging.getLogger(__name__)
 
 
-def from_file(rooms_conf_file):
+def read_conf(rooms_conf_file):
+    """
+    Return the rooms config, with the default values.
+    """
     rconf = ConfigParser()
     rconf.read_dict(
         {
@@ -25,6 +36,8 @@ def from_file(rooms_conf_file):
                 "temperature_sample_size": "6",
                 "temperature_set": "16.0",
                 "temperature_set_default_offset": "0",
+                "temperature_inertia": "0",
+                "heat_demand_weight": "1.0",
                 "window_detection": "on",
                 "window_sample_size": "36",
                 "window_threshold": "0.5",
@@ -32,30 +45,88 @@ def from_file(rooms_conf_file):
                 "radiator_valve_device": "",
                 "humidity_sensor_device": "",
                 "data_dir": "data",
+                "history_size": "8640",
+                "history_store": "no",
+                "history_segment_duration": "86400",
+                "history_compact_after": "604800",
+                "history_compact_step": "600",
+                "state_snapshot_interval": "60",
+                "state_max_age": "600",
             }
         }
     )
     rconf.read_file(open(rooms_conf_file))
+    return rconf
+
+
+def from_file(
+    rooms_conf_file,
+    engine=None,
+    sensors=None,
+    dispatcher=None,
+    persister=None,
+    actuators=None,
+    room_ids=None,
+    stagger=False,
+    clock=None,
+    overrides=None,
+):
+    """
+    Return the rooms of the config file by id, or only the given ones. With
+    stagger, the ticks of the rooms are spread over their period. Overrides
+    are options set in every room.
+    """
+    rconf = read_conf(rooms_conf_file)
+    if overrides:
+        for k in rconf.sections():
+            rconf[k].update(overrides)
+    if sensors is None:
+        sensors = SensorHub()
+    if actuators is None:
+        actuators = ActuatorHub()
     rooms = {}
-    for k in rconf.sections():
+    sections = rconf.sections()
+    for i, k in enumerate(sections):
+        if room_ids is not None and k not in room_ids:
+            continue
         conf = rconf[k]
+        store = None
+        if conf.getboolean("history_store"):
+            store = HistoryStore(
+                os.path.join(conf.get("data_dir"), "history", k),
+                segment_duration=conf.getint("history_segment_duration"),
+                compact_after=conf.getfloat("history_compact_after"),
+                compact_step=conf.getint("history_compact_step"),
+                clock=clock,
+            )
         rooms[k] = Room(
             k,
             label=conf["label"],
             period=conf.getfloat("period"),
-            temperature_sensor=devices.get_device(conf["temperature_sensor_device"]),
+            temperature_sensor=sensors.get(conf["temperature_sensor_device"]),
             temperature_sample_size=conf.getint("temperature_sample_size"),
             temperature_set=conf.getfloat("temperature_set"),
             temperature_set_default_offset=conf.getfloat(
                 "temperature_set_default_offset"
             ),
+            temperature_inertia=conf.getfloat("temperature_inertia"),
+            heat_demand_weight=conf.getfloat("heat_demand_weight"),
             window_detection=conf.getboolean("window_detection"),
             window_sample_size=conf.getint("window_sample_size"),
             window_threshold=conf.getfloat("window_threshold"),
             window_duration=conf.getfloat("window_duration"),
-            radiator_valve_device=devices.get_device(conf["radiator_valve_device"]),
-            humidity_sensor_device=devices.get_device(conf["humidity_sensor_device"]),
+            radiator_valve_device=actuators.get(conf["radiator_valve_device"]),
+            humidity_sensor_device=sensors.get(conf["humidity_sensor_device"]),
             data_dir=conf.get("data_dir"),
+            history_size=conf.getint("history_size"),
+            history_store=store,
+            state_snapshot_interval=conf.getfloat("state_snapshot_interval"),
+            state_max_age=conf.getfloat("state_max_age"),
+            engine=engine,
+            tick_phase=i / len(sections) if stagger else 0.0,
+            dispatcher=dispatcher,
+            persister=persister,
+            clock=clock,
         )
     return rooms
 
@@ -63,7 +134,7 @@ def from_file(rooms_conf_file):
 class Room(Thread):
     """
     A room representation (with sensors like temperature) which runs in a
-    separate thread.
+    separate thread, or is driven by a shared RoomEngine when one is given.
     """
 
     VALVE_CLOSE = 3
@@ -72,10 +143,13 @@ class Room(Thread):
 
     circulator_runs_pushed = None
     pushed_expiration = 1200
+    clock = SYSTEM_CLOCK
+    # Called with each new snapshot, like the writer of a shared state table
+    on_publish = None
 
     @classmethod
     def push_circulator_state(cls, state):
-        cls.circulator_runs_pushed = (bool(state), time())
+        cls.circulator_runs_pushed = (bool(state), cls.clock.time())
 
     def __init__(
         self,
@@ -86,6 +160,8 @@ class Room(Thread):
         temperature_sample_size=6,
         temperature_set=16.0,
         temperature_set_default_offset=0.0,
+        temperature_inertia=0.0,
+        heat_demand_weight=1.0,
         window_detection=True,
         window_sample_size=36,
         window_threshold=0.5,
@@ -93,23 +169,41 @@ class Room(Thread):
         radiator_valve_device=None,
         humidity_sensor_device=None,
         data_dir=None,
+        history_size=0,
+        history_store=None,
+        state_snapshot_interval=0,
+        state_max_age=0,
+        engine=None,
+        tick_phase=0.0,
+        dispatcher=None,
+        persister=None,
+        clock=None,
     ):
 
         super().__init__(name=room_id)
+        if clock is not None:
+            self.clock = clock
         self.room_id = room_id
         self.label = label
         self.period = round(period, 1)
+        self.ticker = Ticker(self.period, phase=tick_phase)
+        self.profiler = StageProfiler(room_id, data_dir or ".")
         self.event = Event()
+        self.engine = engine
+        self.dispatcher = dispatcher
+        self.persister = persister
         self.errors = []
+        self.sched_error = None  # Failure of the last run by the dispatcher
         self.conf = {}
         self.conf_file = "{}/{}.json".format(data_dir, room_id)
         self.lock_file = Lock()
 
         # Temperature data
         self.temp_sensor = temperature_sensor
-        self.temp_sample = deque(maxlen=temperature_sample_size)
+        self.temp_sample = RollingSample(temperature_sample_size)
         self.temp_set = round(temperature_set, 1)
         self.temp_set_offset_default = temperature_set_default_offset
+        self.temp_inertia = temperature_inertia
         self.temp = None
         self.temp_predict = None
         self.temp_set_lock = Lock()
@@ -117,9 +211,10 @@ class Room(Thread):
         self.temp_set_offset_pushed = None
         self.temp_deviation = None
         self.temp_controlled = False
+        self.heat_demand_weight = heat_demand_weight
         # Window data
         self.wind_detection = window_detection
-        self.wind_sample = deque(maxlen=window_sample_size)
+        self.wind_sample = RollingSample(window_sample_size)
         self.wind_threshold = round(window_threshold, 1)
         self.wind_duration = round(window_duration, 1)
         self.wind_opened = None
@@ -131,12 +226,22 @@ class Room(Thread):
         self.circulator_runs = None
         # Humidity data
         self.humid_sensor = humidity_sensor_device
-        self.humid_sample = deque(maxlen=6)
+        self.humid_sample = RollingSample(6)
+        self.humid = None
+        # History of the states, one row per tick
+        self.history = History(history_size) if history_size > 0 else None
+        self.history_store = history_store
+        # Snapshot of the runtime state, for warm restarts
+        self.state_file = "{}/{}_state.json".format(data_dir, room_id)
+        self.state_interval = state_snapshot_interval
+        self.state_max_age = state_max_age
+        self.state_saved = self.clock.time()
         # Scheduler for temp_set
         self.sched = TemperatureScheduler(
             self,
             room_file="{}/{}_scheduler.json".format(data_dir, room_id),
             common_file="{}/common_scheduler.json".format(data_dir),
+            persister=persister,
         )
 
         if self.conf_file:
@@ -152,6 +257,39 @@ class Room(Thread):
                         pass
             except FileNotFoundError:
                 pass
+        self.restore_state()
+        self.snapshot = None
+        self.publish_lock = Lock()
+        self.publish(alive=False)
+
+    def publish(self, alive=None):
+        """
+        Publish a snapshot of the room state for readers like the API.
+        """
+        if alive is None:
+            alive = self.is_alive() and not self.event.is_set()
+        # Mode cached by the scheduler, so that no tick waits for its lock
+        mode = self.sched.mode
+        with self.publish_lock:
+            snapshot = RoomSnapshot(self, is_alive=alive, sched_curr_mode=mode)
+            if not snapshot.same_state(self.snapshot):
+                snapshot.stamp()
+                self.snapshot = snapshot
+                if self.on_publish is not None:
+                    self.on_publish(snapshot)
+
+    def dump(self):
+        """
+        Return the attributes of the room and of its scheduler.
+        """
+        data = {k: v for k, v in vars(self).items() if k[0] != "_"}
+        data["is_alive"] = self.is_alive()
+        data["ticker"] = self.ticker.stats()
+        data["sched"] = {k: v for k, v in vars(self.sched).items() if k[0] != "_"}
+        data["sched"]["daily_presets"] = self.sched.daily_presets
+        data["sched"]["next_schedule"] = self.sched.next_schedule()
+        data["sched"]["timeline"] = self.sched.timeline
+        return data
 
     def _save_to_persistent(self):
         if self.conf_file:
@@ -159,13 +297,122 @@ class Room(Thread):
                 self.conf["temp_set"] = self.temp_set
             # Dump in a string to protect the file from a JSON exception
             s = json.dumps(self.conf, indent=4)
+            if self.persister is not None:
+                self.persister.write(self.conf_file, s, on_error=self._write_error)
+            else:
+                try:
+                    with self.lock_file:
+                        write_atomic(self.conf_file, s)
+                except OSError as e:
+                    self._write_error(e)
+
+    def _write_error(self, e, path=None):
+        msg = 'Failed to write to "{}": {}'.format(path or self.conf_file, e)
+        self.errors.append(msg)
+        logger.error("Room {}: {}".format(self.room_id, msg))
+
+    def save_state(self, sync=False):
+        """
+        Snapshot the runtime state (samples, window and pushed values) to the
+        state file, so that a restart controls the valve from its first tick.
+        With sync, the file is written before returning.
+        """
+        now = self.clock.time()
+        state = {
+            "time": now,
+            "period": self.period,
+            "temp_sample": list(self.temp_sample),
+            "wind_sample": list(self.wind_sample),
+            "humid_sample": list(self.humid_sample),
+            "wind_time": self.wind_time,
+            "temp_set_offset_pushed": self.temp_set_offset_pushed,
+            "circulator_runs_pushed": self.circulator_runs_pushed,
+        }
+        self.state_saved = now
+        s = json.dumps(state, separators=(",", ":"))
+        if self.persister is not None:
+            self.persister.write(
+                self.state_file,
+                s,
+                on_error=lambda e: self._write_error(e, self.state_file),
+            )
+            if sync:
+                self.persister.flush()
+        else:
             try:
-                with self.lock_file, open(self.conf_file, "w") as f:
-                    f.write(s)
+                write_atomic(self.state_file, s)
             except OSError as e:
-                msg = 'Failed to write to "{}": {}'.format(self.conf_file, e)
-                self.errors.append(msg)
-                logger.error("Room {}: {}".format(self.room_id, msg))
+                self._write_error(e, self.state_file)
+
+    def restore_state(self):
+        """
+        Restore the runtime state from the state file, unless it is older
+        than state_max_age seconds. Samples are kept only if the period has
+        not changed. Return True if the state has been restored.
+        """
+        if not self.state_max_age:
+            return False
+        try:
+            with open(self.state_file, "r") as f:
+                state = json.load(f)
+            age = self.clock.time() - state["time"]
+            if not 0 <= age <= self.state_max_age:
+                logger.info(
+                    'room "{}": state snapshot is too old ({:.0f}s), '
+                    "ignored".format(self.label, age)
+                )
+                return False
+            samples = {}
+            if state["period"] == self.period:
+                for k in ("temp_sample", "wind_sample", "humid_sample"):
+                    samples[k] = [None if v is None else float(v) for v in state[k]]
+            wind_time = float(state["wind_time"])
+            offset = state["temp_set_offset_pushed"]
+            circul = state["circulator_runs_pushed"]
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(
+                'room "{}": failed to read state snapshot "{}": {}'.format(
+                    self.label, self.state_file, e
+                )
+            )
+            return False
+        for k, values in samples.items():
+            sample = getattr(self, k)
+            for v in values:
+                sample.append(v)
+        self.wind_time = wind_time
+        if offset is not None:
+            self.temp_set_offset_pushed = tuple(offset)
+        pushed = type(self).circulator_runs_pushed
+        if circul is not None and (pushed is None or pushed[1] < circul[1]):
+            type(self).circulator_runs_pushed = tuple(circul)
+        logger.info(
+            'room "{}": state restored from a {:.0f}s old snapshot'.format(
+                self.label, age
+            )
+        )
+        return True
+
+    def start(self):
+        if self.dispatcher is not None:
+            self.dispatcher.add(self.sched)
+        if self.engine is None:
+            super().start()
+        else:
+            logger.debug(
+                'room "{}": start room id "{}" in engine'.format(
+                    self.label, self.room_id
+                )
+            )
+            self.engine.add(self)
+        self.publish()
+
+    def is_alive(self):
+        if self.engine is None:
+            return super().is_alive()
+        return self.engine.is_running(self)
 
     def run(self):
         """
@@ -174,12 +421,32 @@ class Room(Thread):
 
         logger.debug('room "{}": start room id "{}"'.format(self.label, self.room_id))
 
-        # Start infinite loop that acquire measures
+        # Start infinite loop that acquire measures, on the ticker deadlines
+        while not self.event.is_set():
+            deadline = self.ticker.next()
+            if self.event.wait(max(0.0, deadline - monotonic())):
+                break
+            if not self._timed_tick(deadline):
+                break
+
+    def _timed_tick(self, deadline):
+        """
+        Run one acquisition step due at the deadline, recording its timing.
+        """
+        start = monotonic()
+        alive = self.profiler.run(self._tick)
+        end = monotonic()
+        self.ticker.record(deadline, start, end)
+        ROOM_TICK.observe(end - start, self.room_id)
+        return alive
+
+    def _tick(self):
+        """
+        Run one acquisition step. Return False if the room has crashed.
+        """
         try:
-            while not self.event.is_set():
-                if self.temp_sensor:
-                    self._do_stuff()
-                self.event.wait(self.period)
+            if self.temp_sensor:
+                self._do_stuff()
         except Exception as e:
             if self.valve is not None:
                 try:
@@ -193,8 +460,12 @@ class Room(Thread):
                     logger.exception("{}: {}".format(self.room_id, self.errors[-1]))
             self.errors.append("FATAL ERROR: {}".format(e))
             logger.exception("{}: {}".format(self.room_id, self.errors[-1]))
+            self.publish(alive=False)
+            return False
+        return True
 
     def _do_stuff(self):
+        lap = self.profiler.start()
         errors = []
         # Acquire temperature and humidity
         (temp, humid) = (None, None)
@@ -208,58 +479,64 @@ class Room(Thread):
                     )
                     logger.error("{}: {}".format(self.room_id, errors[-1]))
         else:
+            # Read both devices concurrently
+            read_temp = read_later(self.temp_sensor, "temperature")
+            read_humid = read_later(self.humid_sensor, "humidity")
             if self.temp_sensor is not None:
                 try:
-                    temp = self.temp_sensor.temperature
+                    temp = read_temp()
                 except Exception as e:
                     errors.append("Failed to read temperature: {}".format(e))
                     logger.error("{}: {}".format(self.room_id, errors[-1]))
             if self.humid_sensor is not None:
                 try:
-                    humid = self.humid_sensor.humidity
+                    humid = read_humid()
                 except Exception as e:
                     errors.append("Failed to read humidity: {}".format(e))
                     logger.error("{}: {}".format(self.room_id, errors[-1]))
         self.temp_sample.append(temp)
         self.wind_sample.append(temp)
         self.humid_sample.append(humid)
+        lap("acquire")
 
-        #  Compute average temperature
-        # sum_, count = 0, 0
-        # for val in self.temp_sample:
-        #     if val is not None:
-        #         sum_ += val
-        #         count += 1
-        # if count >= round(0.7 * self.temp_sample.maxlen, 0):
-        #     self.temp = round(sum_ / count, 1)
-        # else:
-        #     self.temp = None
-        sample = [v for v in self.temp_sample if v is not None]
-        if len(sample) >= round(0.7 * self.temp_sample.maxlen, 0):
-            self.temp = round(sum(sample) / len(sample), 1)
+        # Compute average temperature
+        if self.temp_sample.count >= round(0.7 * self.temp_sample.maxlen, 0):
+            self.temp = round(self.temp_sample.mean(), 1)
         else:
             self.temp = None
 
         # Compute humidity
-        try:
-            self.humid = [v for v in self.humid_sample if v is not None][-1]
-        except IndexError:
-            pass
+        if self.humid_sample.last is not None:
+            self.humid = self.humid_sample.last
 
-        # Compute predictable temperature we expect in inertie time
-        # WISH LIST: compute a linear regression?
+        # Compute predictable temperature we expect in inertie time, from
+        # the linear regression of the (longer) window sample
         self.temp_predict = self.temp
-        # Run the scheduler for the temperature set
-        try:
-            self.sched.run_pending()
-        except Exception as e:
-            errors.append(("Failed to run scheduler: {}").format(e))
-            logger.error("{}: {}".format(self.room_id, errors[-1]))
+        if self.temp is not None and self.temp_inertia > 0:
+            sample = self.wind_sample
+            if sample.count >= round(0.7 * sample.maxlen, 0):
+                predict = sample.predict(self.temp_inertia / self.period)
+                if predict is not None:
+                    self.temp_predict = round(predict, 1)
+        lap("average")
+        # Run the scheduler for the temperature set, unless a dispatcher
+        # runs it when a transition is due
+        if self.dispatcher is None:
+            try:
+                self.sched.run_pending()
+            except Exception as e:
+                errors.append(("Failed to run scheduler: {}").format(e))
+                logger.error("{}: {}".format(self.room_id, errors[-1]))
+        elif self.sched_error is not None:
+            errors.append(self.sched_error)
+        lap("scheduler")
         # Compute Window state
         self.wind_opened = self._detect_opened_window()
+        lap("window")
         # Use temperature setpoint offset if not expired, or use default value
         t_set_offset = self.temp_set_offset_pushed
-        if t_set_offset and t_set_offset[1] > time() - self.pushed_expiration:
+        now = self.clock.time()
+        if t_set_offset and t_set_offset[1] > now - self.pushed_expiration:
             self.temp_set_offset = t_set_offset[0]
             self.temp_controlled = True
         else:
@@ -275,15 +552,17 @@ class Room(Thread):
             except TypeError:
                 pass
         self.temp_deviation = temp_dev
+        lap("deviation")
 
         # Read circulator state or acquire it
         circul_runs = self.circulator_runs_pushed
-        if circul_runs and circul_runs[1] > (time() - self.pushed_expiration):
+        if circul_runs and circul_runs[1] > (now - self.pushed_expiration):
             self.circulator_runs = circul_runs[0]
         else:
             # TODO: get circulator state on our own
             self.circulator_runs = None
 
+        lap("circulator")
         # Take decision to open, close or release valve
         if not self.circulator_runs:
             self.valve_order = self.VALVE_RELEASE
@@ -296,6 +575,7 @@ class Room(Thread):
         else:
             self.valve_order = self.VALVE_OPEN
 
+        lap("decision")
         # Apply decision
         if self.valve:
             try:
@@ -309,7 +589,15 @@ class Room(Thread):
                 errors.append("Failed to manoeuvre the valve: {}".format(e))
                 logger.error("{}: {}".format(self.room_id, errors[-1]))
 
+        lap("actuation")
         self.errors = errors
+        self._record_history()
+        lap("history")
+        if self.state_interval and now - self.state_saved >= self.state_interval:
+            self.save_state()
+        lap("state")
+        self.publish()
+        lap("publish")
         # logger.debug('room {}: temp_sample=[{}], average_temp={}'.format(
         #          self.room_id, self.temp_sample, value))
         # logger.debug(('room {}: window_sample=[{}], sample_max={}, '
@@ -317,6 +605,40 @@ class Room(Thread):
         #                   self.room_id, self.wind_sample, maxi,
         #                   int(self.wind_time - time())))
 
+    def _record_history(self):
+        state = {
+            "temp": self.temp,
+            "humid": self.humid,
+            "temp_set": self.temp_set,
+            "temp_deviation": self.temp_deviation,
+            "valve_order": self.valve_order,
+            "wind_opened": self.wind_opened,
+        }
+        now = self.clock.time()
+        if self.history is not None:
+            self.history.append(now, **state)
+        # Once stopped, the store is closed and left to a new room
+        if self.history_store is not None and not self.event.is_set():
+            try:
+                self.history_store.append(now, **state)
+            except OSError as e:
+                self.errors.append("Failed to write history: {}".format(e))
+                logger.error("{}: {}".format(self.room_id, self.errors[-1]))
+
+    def history_query(self, from_=None, to=None, step=None):
+        """
+        Return the history between the two timestamps, aggregated by steps.
+        The on-disk store is used when the in-memory history does not go back
+        far enough.
+        """
+        if self.history_store is not None:
+            oldest = self.history.oldest() if self.history is not None else None
+            if oldest is None or from_ is None or from_ < oldest:
+                return self.history_store.query(from_, to, step)
+        if self.history is None:
+            return None
+        return self.history.query(from_, to, step)
+
     def temperature_deviation(self, setpoint_offset=None):
         """
         Get the room temperature deviation in reference to the setpoint.
@@ -324,7 +646,7 @@ class Room(Thread):
         """
         if setpoint_offset is not None:
             offset = setpoint_offset
-            self.temp_set_offset_pushed = (setpoint_offset, time())
+            self.push_temp_set_offset(setpoint_offset)
         else:
             offset = 0
 
@@ -337,6 +659,12 @@ class Room(Thread):
                 pass
         return temp_dev
 
+    def push_temp_set_offset(self, offset):
+        """
+        Record the setpoint offset pushed by the controller.
+        """
+        self.temp_set_offset_pushed = (offset, self.clock.time())
+
     def _detect_opened_window(self):
         """
         Return True if we know that a window has been opened recently, False
@@ -345,26 +673,22 @@ class Room(Thread):
         if not self.wind_detection:
             return None
         else:
-            sample = [v for v in self.wind_sample if v is not None]
             # Not enough data available
-            if len(sample) < 2 * self.temp_sample.maxlen:
+            if self.wind_sample.count < 2 * self.temp_sample.maxlen:
                 return False
             # A window opening is detected when the temperature falls too
             # much during the sample.
-            maxi = -42.0
-            for t in sample:
-                if maxi - t >= self.wind_threshold:
-                    # Report only when the previous opening is older than
-                    # window sample duration.
-                    if self.wind_time < (time() - len(self.wind_sample) * self.period):
-                        logger.info(
-                            ('room "{}": opened window detected!').format(self.label)
-                        )
-                    self.wind_time = time()
-                    break
-                elif t > maxi:
-                    maxi = t
-            return time() - self.wind_time < self.wind_duration
+            drop = self.wind_sample.max_drop()
+            if drop is not None and drop >= self.wind_threshold:
+                # Report only when the previous opening is older than
+                # window sample duration.
+                now = self.clock.time()
+                if self.wind_time < (now - len(self.wind_sample) * self.period):
+                    logger.info(
+                        ('room "{}": opened window detected!').format(self.label)
+                    )
+                self.wind_time = now
+            return self.clock.time() - self.wind_time < self.wind_duration
 
     def set_temp_set(self, T):
         """
@@ -380,10 +704,20 @@ class Room(Thread):
         with self.temp_set_lock:
             self.temp_set = round(T, 1)
         self._save_to_persistent()
+        self.publish()
 
     def stop(self):
         """
-        Stop thread.
+        Stop thread, or unschedule the room from the engine.
         """
         logger.debug('room "{}": stop room'.format(self.label))
         self.event.set()
+        if self.engine is not None:
+            self.engine.remove(self)
+        if self.dispatcher is not None:
+            self.dispatcher.remove(self.sched)
+        if self.history_store is not None:
+            self.history_store.flush()
+        if self.state_interval:
+            self.save_state(sync=True)
+        self.publish(alive=False)
@@ -1,10 +1,17 @@
+import heapq
 import json
 import logging
+import os
 import re
-from datetime import date
-from schedule import Scheduler
-from time import time
-from threading import Lock
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from itertools import count
+from threading import Condition, Lock, Thread
+from weakref import WeakSet
+
+from .clock import SYSTEM_CLOCK
+from .metrics import SCHEDULER_LOCK_WAIT, TimedLock
+from .persistence import write_atomic
 
 logger = logging.getLogger(__name__)
 
@@ -23,24 +30,160 @@ class RoomSchedulerError:
     pass
 
 
+def week_second(timestamp):
+    """
+    Return the number of seconds elapsed since monday 00:00 (local time).
+    """
+    dt = datetime.fromtimestamp(timestamp)
+    return dt.weekday() * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+
+
+def week_timestamp(timestamp, second, weeks=0):
+    """
+    Return the timestamp of the given second of the week of the timestamp,
+    shifted by a number of weeks.
+    """
+    day = date.fromtimestamp(timestamp)
+    monday = day - timedelta(days=day.weekday() - 7 * weeks)
+    dt = datetime(monday.year, monday.month, monday.day) + timedelta(seconds=second)
+    return dt.timestamp()
+
+
+class PresetRegistry:
+    """
+    Daily presets of a common scheduler file, loaded once and shared by
+    reference between the schedulers of every room. The file is watched
+    through its inode and modification time: on change, presets are reloaded
+    and only the schedulers using a modified preset are recompiled.
+    """
+
+    # Minimal seconds between two checks of the file
+    check_interval = 10.0
+    registries = {}
+    registries_lock = Lock()
+
+    @classmethod
+    def get(cls, path, clock=None):
+        """
+        Return the registry of the file, created on first use.
+        """
+        path = os.path.abspath(path)
+        with cls.registries_lock:
+            try:
+                return cls.registries[path]
+            except KeyError:
+                registry = cls.registries[path] = cls(path, clock=clock)
+                return registry
+
+    @classmethod
+    def check_all(cls):
+        with cls.registries_lock:
+            registries = list(cls.registries.values())
+        for registry in registries:
+            registry.check()
+
+    def __init__(self, path, clock=None):
+        self.path = path
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.lock = Lock()
+        self.schedulers = WeakSet()
+        self.stamp = None
+        self.last_check = self.clock.time()
+        # Minimal and default configuration
+        self.default_presets = {
+            "at_home": {
+                "label": "At home",
+                "hour-temp": {"get_up": "here", "bedtime": "sleeping"},
+            }
+        }
+        self.daily_presets = dict(self.default_presets)
+        self._load()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _load(self):
+        """
+        (Re)load the file and return the names of the modified presets.
+        """
+        stamp = self._stat()
+        presets = dict(self.default_presets)
+        if stamp is not None:
+            try:
+                with open(self.path, "r") as f:
+                    presets.update(json.load(f)["daily_presets"])
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(
+                    'Failed to load presets from "{}": {}'.format(self.path, e)
+                )
+                return set()
+        old = self.daily_presets
+        changed = {k for k in set(old) | set(presets) if old.get(k) != presets.get(k)}
+        # Swap the whole dict so that readers never see a partial update
+        self.daily_presets = presets
+        self.stamp = stamp
+        return changed
+
+    def subscribe(self, sched):
+        with self.lock:
+            self.schedulers.add(sched)
+
+    def check(self, force=False):
+        """
+        Reload the presets if the file has changed, and recompile the
+        schedulers using a modified preset.
+        """
+        with self.lock:
+            now = self.clock.time()
+            if not force and now - self.last_check < self.check_interval:
+                return
+            self.last_check = now
+            if self._stat() == self.stamp:
+                return
+            changed = self._load()
+            affected = [
+                s
+                for s in self.schedulers
+                if changed.intersection(s.weekly_scheduling.values())
+            ]
+        if changed:
+            logger.info(
+                'Presets {} reloaded from "{}"'.format(sorted(changed), self.path)
+            )
+        for sched in affected:
+            sched.recompile()
+
+
 class TemperatureScheduler:
 
-    def __init__(self, room, room_file, common_file):
+    def __init__(self, room, room_file, common_file, persister=None):
         self.room = room
+        self.clock = room.clock
+        self.persister = persister
+        self.dispatcher = None
         self.room_file = room_file
         self.common_file = common_file
         self.last_set = (None, None)
-        self.lock = Lock()
+        self.lock = TimedLock(SCHEDULER_LOCK_WAIT, room.room_id)
         self.onetime_sched = {}
         self.weekly_enabled = True
         self.weekly_new = False
-        self.weekly_sched = Scheduler()
+        self.weekly_next_run = None
         self.weekly_suspended = False
         self.weekly_temp = None
+        # Weekly plan compiled into sorted (week second, temperature, preset
+        # label) transitions
+        self.timeline = []
+        self.timeline_secs = []
+        # Mode at the last run or edit, read by the room without the lock
+        self.mode = None
         # Minimal and default configuration
         self.hourly_presets = {"get_up": "08:00", "bedtime": "21:00"}
         self.temp_presets = {"here": 18.0, "away": 16.0, "sleeping": 17.0}
-        self.daily_presets = {"at_home": [("get_up", "here"), ("bedtime", "sleeping")]}
         self.weekly_scheduling = {
             "monday": None,
             "tuesday": None,
@@ -50,15 +193,10 @@ class TemperatureScheduler:
             "saturday": None,
             "sunday": None,
         }
-        # Load common file
-        FileNotFoundError = Exception
-        try:
-            with open(self.common_file, "r") as f:
-                conf = json.load(f)
-                self.daily_presets.update(conf["daily_presets"])
-        except FileNotFoundError:
-            pass
+        # Daily presets shared with the other rooms
+        self.registry = PresetRegistry.get(self.common_file, self.clock)
         # Load room file
+        FileNotFoundError = Exception
         try:
             with open(self.room_file, "r") as f:
                 conf = json.load(f)
@@ -70,10 +208,6 @@ class TemperatureScheduler:
                     self.weekly_scheduling[k] = conf["weekly_scheduling"][k]
         except FileNotFoundError:
             pass
-        for k, v in self.weekly_scheduling.items():
-            if v:
-                self.schedule_daily_preset(day=k, preset=v, persistent=False)
-
         # Check config correctness
         for t in self.temp_presets.values():
             self._parse_temp(t)
@@ -91,23 +225,93 @@ class TemperatureScheduler:
             elif not self.onetime_sched["action"] == "resume_weekly":
                 raise ValueError("Incorrect value for onetime schedule action")
 
-        # Get the last weekly temperature set
-        if self.weekly_sched.jobs:
-            self.weekly_temp = sorted(self.weekly_sched.jobs)[-1].job_func.args[0]
+        self.compile()
+        self.registry.subscribe(self)
+        # Get the current weekly temperature set
+        if self.timeline:
+            self.weekly_temp = self._transition_at(self.clock.time())[1]
 
-    def _save_to_persistent(self):
-        # Save to common file
-        conf = {"daily_presets": self.daily_presets}
-        # Dump into a string to protect the file from a JSON error
-        s = json.dumps(conf, indent=4)
+    @property
+    def daily_presets(self):
+        return self.registry.daily_presets
+
+    def recompile(self):
+        """
+        Compile the weekly plan again after a change of the presets.
+        """
         try:
-            with open(self.common_file, "w") as f:
-                f.write(s)
-        except OSError as e:
-            msg = "Unable to save configuration on disk: {}".format(e)
-            logger.error("Room {}: {}".format(self.room.room_id, msg))
-            raise RoomSchedulerError(msg)
-        # Save to room file
+            with self.lock:
+                self.compile()
+        except (KeyError, ValueError) as e:
+            logger.error(
+                "Room {}: failed to compile weekly plan: {}".format(
+                    self.room.room_id, e
+                )
+            )
+            return
+        self._replan()
+
+    def compile(self):
+        """
+        Compile the weekly scheduling into the timeline of transitions.
+        """
+        timeline = []
+        for i, day in enumerate(weekdays):
+            preset = self.weekly_scheduling[day]
+            if not preset:
+                continue
+            label = self.daily_presets[preset]["label"]
+            for h, t in self.daily_presets[preset]["hour-temp"].items():
+                hour, minute = self._parse_hour(h).split(":")
+                second = i * 86400 + int(hour) * 3600 + int(minute) * 60
+                timeline.append((second, self._parse_temp(t), label))
+        timeline.sort(key=lambda x: x[0])
+        self.timeline = timeline
+        self.timeline_secs = [x[0] for x in timeline]
+        self.weekly_next_run = self._next_transition(self.clock.time())[0]
+        self.mode = self._current_mode()
+
+    def _transition_at(self, timestamp):
+        """
+        Return the transition in effect at the timestamp.
+        """
+        i = bisect_right(self.timeline_secs, week_second(timestamp))
+        # Index -1 is the last transition of the previous week
+        return self.timeline[i - 1]
+
+    def _next_transition(self, timestamp):
+        """
+        Return the timestamp and the transition following the timestamp, or
+        (None, None) if there is no transition.
+        """
+        if not self.timeline:
+            return (None, None)
+        i = bisect_right(self.timeline_secs, week_second(timestamp))
+        if i < len(self.timeline):
+            return (week_timestamp(timestamp, self.timeline_secs[i]), self.timeline[i])
+        return (week_timestamp(timestamp, self.timeline_secs[0], 1), self.timeline[0])
+
+    def next_run_time(self):
+        """
+        Return the timestamp of the next transition, weekly or onetime, or
+        None if nothing is scheduled.
+        """
+        with self.lock:
+            times = [self.weekly_next_run]
+            if self.onetime_sched:
+                times.append(self.onetime_sched["at"])
+                # The weekly suspension is applied by a run of the scheduler
+                if self.onetime_sched["suspend"] and not self.weekly_suspended:
+                    times.append(self.onetime_sched["suspend_at"] or 0)
+        times = [t for t in times if t is not None]
+        return min(times) if times else None
+
+    def _replan(self):
+        if self.dispatcher is not None:
+            self.dispatcher.replan(self)
+
+    def _save_to_persistent(self):
+        # Save to room file, daily presets being owned by the registry
         conf = {
             "onetime_scheduling": self.onetime_sched,
             "enable_weekly_scheduling": self.weekly_enabled,
@@ -115,13 +319,23 @@ class TemperatureScheduler:
             "hourly_presets": self.hourly_presets,
             "temp_presets": self.temp_presets,
         }
-        s = json.dumps(conf, indent=4)
-        try:
-            with open(self.room_file, "w") as f:
-                f.write(s)
-        except OSError as e:
-            msg = "Unable to save configuration on disk: {}".format(e)
-            logger.error("Room {}: {}".format(self.room.room_id, msg))
+        self._write(self.room_file, json.dumps(conf, indent=4))
+
+    def _write(self, path, data):
+        """
+        Write to the file, through the write-behind persister if any.
+        """
+        if self.persister is not None:
+            self.persister.write(path, data, on_error=self._write_error)
+        else:
+            try:
+                write_atomic(path, data)
+            except OSError as e:
+                self._write_error(e)
+
+    def _write_error(self, e):
+        msg = "Unable to save configuration on disk: {}".format(e)
+        logger.error("Room {}: {}".format(self.room.room_id, msg))
 
     def _parse_hour(self, hour):
         h = hour
@@ -148,41 +362,58 @@ class TemperatureScheduler:
                     "Not a temperature preset nor a float: {}".format(temp)
                 )
 
-    def _job_temp(self, temp):
-        self.weekly_temp = temp
-        self.weekly_new = True
-
     def current_mode(self):
         with self.lock:
-            if self.onetime_sched and (
-                self.weekly_suspended
-                or not self.weekly_enabled
-                or not self.weekly_sched.jobs
-                or self.onetime_sched["at"] <= self.weekly_sched.next_run.timestamp()
-            ):
-                return "Onetime"
-            elif self.weekly_enabled:
-                weekday_name = weekdays[date.today().weekday()]
-                preset = self.weekly_scheduling[weekday_name]
-                if preset is not None:
-                    return self.daily_presets[preset]["label"]
+            return self._current_mode()
+
+    def _current_mode(self):
+        if self.onetime_sched and (
+            self.weekly_suspended
+            or not self.weekly_enabled
+            or not self.timeline
+            or self.onetime_sched["at"] <= self.weekly_next_run
+        ):
+            return "Onetime"
+        elif self.weekly_enabled and self.timeline:
+            return self._transition_at(self.clock.time())[2]
+
+    def summary(self):
+        """
+        Return the scheduling settings and the next transition.
+        """
+        data = {
+            k: v
+            for k, v in vars(self).items()
+            if k
+            in [
+                "weekly_enabled",
+                "weekly_scheduling",
+                "onetime_sched",
+                "temp_presets",
+                "hourly_presets",
+            ]
+        }
+        data["daily_presets"] = self.daily_presets
+        data["next_schedule"] = self.next_schedule()
+        return data
 
     def disable_weekly(self):
         with self.lock:
             self.weekly_enabled = False
+            self.mode = self._current_mode()
             self._save_to_persistent()
+        self._replan()
 
     def enable_weekly(self):
         with self.lock:
             self.weekly_enabled = True
+            self.mode = self._current_mode()
             self._save_to_persistent()
+        self._replan()
 
     def next_schedule(self):
         with self.lock:
-            if self.weekly_sched.next_run:
-                next_w_sched = self.weekly_sched.next_run.timestamp()
-            else:
-                next_w_sched = None
+            next_w_sched, transition = self._next_transition(self.clock.time())
             if self.onetime_sched:
                 if self.onetime_sched["suspend_at"] and (
                     not next_w_sched or self.onetime_sched["suspend_at"] <= next_w_sched
@@ -204,26 +435,29 @@ class TemperatureScheduler:
                     }
 
             if self.weekly_enabled and not self.weekly_suspended and next_w_sched:
-                next_job = sorted(self.weekly_sched.jobs)[0]
-                day = list(next_job.tags)[0]
-                preset = self.weekly_scheduling[day]
                 return {
                     "mode": "weekly",
-                    "preset_l": self.daily_presets[preset]["label"],
+                    "preset_l": transition[2],
                     "time": next_w_sched,
                     "action": "set",
-                    "temp": next_job.job_func.args[0],
+                    "temp": transition[1],
                 }
             else:
                 return None
 
     def run_pending(self):
+        if self.dispatcher is None:
+            self.registry.check()
         with self.lock:
             self.weekly_new = False
-            self.weekly_sched.run_pending()
+            now = self.clock.time()
+            if self.weekly_next_run is not None and self.weekly_next_run <= now:
+                self.weekly_temp = self._transition_at(now)[1]
+                self.weekly_new = True
+                self.weekly_next_run = self._next_transition(now)[0]
             temp = None
             # Get one time temperature set, if any
-            if self.onetime_sched and self.onetime_sched["at"] <= time():
+            if self.onetime_sched and self.onetime_sched["at"] <= now:
                 if self.onetime_sched["action"] == "set":
                     temp = self.onetime_sched["temp"]
                 elif self.onetime_sched["action"] == "resume_weekly":
@@ -236,12 +470,13 @@ class TemperatureScheduler:
                 and self.onetime_sched["suspend"]
                 and (
                     not self.onetime_sched["suspend_at"]
-                    or self.onetime_sched["suspend_at"] <= time()
+                    or self.onetime_sched["suspend_at"] <= now
                 )
             ):
                 self.weekly_suspended = True
             else:
                 self.weekly_suspended = False
+            self.mode = self._current_mode()
         # Fall back to weekly scheduling
         if (
             temp is None
@@ -254,17 +489,21 @@ class TemperatureScheduler:
         if temp is not None:
             parsed_temp = self._parse_temp(temp)
             self.room.set_temp_set(parsed_temp)
-            self.last_set = (parsed_temp, time())
+            self.last_set = (parsed_temp, self.clock.time())
 
     def schedule_daily_preset(self, day, preset, persistent=True):
         with self.lock:
-            self.weekly_sched.clear(day)
-            for h, t in self.daily_presets[preset]["hour-temp"].items():
-                job = getattr(self.weekly_sched.every(), day)
-                job.at(self._parse_hour(h)).do(self._job_temp, t).tag(day)
+            old = self.weekly_scheduling.get(day)
             self.weekly_scheduling[day] = preset
+            try:
+                self.compile()
+            except Exception:
+                # Keep the plan compilable, like with an unknown preset
+                self.weekly_scheduling[day] = old
+                raise
             if persistent:
                 self._save_to_persistent()
+        self._replan()
 
     def schedule_onetime_temp(
         self, time, temp, suspend_weekly_sched=False, suspend_at=None
@@ -278,7 +517,9 @@ class TemperatureScheduler:
                 "suspend": suspend_weekly_sched,
                 "suspend_at": suspend_at,
             }
+            self.mode = self._current_mode()
             self._save_to_persistent()
+        self._replan()
 
     def schedule_weekly_resumption(self, time, suspend_at=None):
         with self.lock:
@@ -288,7 +529,122 @@ class TemperatureScheduler:
                 "suspend": True,
                 "suspend_at": suspend_at,
             }
+            self.mode = self._current_mode()
             self._save_to_persistent()
+        self._replan()
+
+
+class ScheduleDispatcher:
+    """
+    Process-wide timer that sleeps until the earliest transition of the
+    registered schedulers and runs only the schedulers it is due for.
+    """
+
+    # Wake up at least that often, to be robust to clock changes and to
+    # check the preset files
+    max_sleep = 10.0
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.cond = Condition()
+        self.queue = []  # Heap of (timestamp, sequence, scheduler)
+        self.planned = {}  # Scheduler -> timestamp of its next run
+        self.seq = count()
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        with self.cond:
+            if self.thread is not None:
+                return
+            self.stopped = False
+            self.thread = Thread(
+                target=self._loop, name="schedule-dispatcher", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.planned.clear()
+            self.queue.clear()
+            self.cond.notify()
+        self.thread = None
+
+    def add(self, sched):
+        self.start()
+        sched.dispatcher = self
+        self.replan(sched)
+
+    def remove(self, sched):
+        with self.cond:
+            self.planned.pop(sched, None)
+            # Drop the entries of the scheduler, so that neither it nor its
+            # room are kept alive until their planned time
+            self.queue = [entry for entry in self.queue if entry[2] is not sched]
+            heapq.heapify(self.queue)
+        sched.dispatcher = None
+
+    def _purge(self):
+        """
+        Drop the heap entries replaced by a later planning.
+        """
+        self.queue = [e for e in self.queue if self.planned.get(e[2]) == e[0]]
+        heapq.heapify(self.queue)
+
+    def replan(self, sched, not_before=None):
+        """
+        Plan the next run of the scheduler, after a run or an edit.
+        """
+        ts = sched.next_run_time()
+        if ts is not None and not_before is not None:
+            ts = max(ts, not_before)
+        with self.cond:
+            if sched.dispatcher is not self:
+                return
+            self.planned[sched] = ts
+            if ts is not None:
+                heapq.heappush(self.queue, (ts, next(self.seq), sched))
+                # Edits leave outdated entries behind until their time
+                if len(self.queue) > 2 * len(self.planned) + 16:
+                    self._purge()
+                self.cond.notify()
+
+    def _loop(self):
+        while True:
+            PresetRegistry.check_all()
+            due = []
+            with self.cond:
+                if self.stopped:
+                    return
+                now = self.clock.time()
+                while self.queue and self.queue[0][0] <= now:
+                    ts, _, sched = heapq.heappop(self.queue)
+                    # Skip entries replaced by a later planning
+                    if sched in self.planned and self.planned[sched] == ts:
+                        del self.planned[sched]
+                        due.append(sched)
+                if not due:
+                    timeout = self.max_sleep
+                    if self.queue:
+                        timeout = min(timeout, self.queue[0][0] - now)
+                    self.cond.wait(timeout)
+                    continue
+            for sched in due:
+                retry = None
+                try:
+                    sched.run_pending()
+                except Exception as e:
+                    # Not retried at once, the transition being still due
+                    retry = self.clock.time() + self.max_sleep
+                    # Reported by the room until a run succeeds
+                    sched.room.sched_error = "Failed to run scheduler: {}".format(e)
+                    logger.error(
+                        "Room {}: {}".format(sched.room.room_id, sched.room.sched_error)
+                    )
+                else:
+                    sched.room.sched_error = None
+                self.replan(sched, not_before=retry)
 
 
 if __name__ in ["__main__", "__console__"]:
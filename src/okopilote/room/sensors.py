@@ -0,0 +1,257 @@
+import logging
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from threading import Lock, RLock
+from time import monotonic
+
+from okopilote.devices.common import devices
+
+from .executor import DaemonExecutor
+from .loader import PendingDevice
+from .metrics import SENSOR_FAILURES, SENSOR_READ
+
+logger = logging.getLogger(__name__)
+
+COMBINED = ("temperature", "humidity", "temperature_humidity")
+
+
+class SensorTimeout(TimeoutError):
+    pass
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def read_later(sensor, attr):
+    """
+    Start reading the attribute of the sensor and return a function that
+    returns the value, or raises the failure, once read. Reads of several
+    shared sensors started together run concurrently.
+    """
+    if sensor is None:
+        return lambda: None
+    if isinstance(sensor, SharedSensor):
+        return sensor.read_later(attr)
+    return lambda: getattr(sensor, attr)
+
+
+class SharedSensor:
+    """
+    Proxy of a sensor device shared by several rooms. The device is physically
+    read at most once per TTL and the result, or the failure, is served to
+    every room reading it in the meantime.
+
+    When an executor is given, the device is read by it and a read taking
+    more than `timeout` seconds fails with SensorTimeout, while it goes on in
+    the background. After consecutive timeouts, the device is not read again
+    for a back-off time doubling up to `max_backoff` seconds.
+    """
+
+    def __init__(
+        self, name, device, ttl=5.0, executor=None, timeout=3.0, max_backoff=300.0
+    ):
+        self.name = name
+        self.device = device
+        self.ttl = ttl
+        self.executor = executor
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.lock = RLock()
+        self.reads = 0
+        self.values = {}  # Attribute name -> (value, exception, timestamp)
+        self.pending = {}  # Read key -> future of the values
+        self.timeouts = 0  # Consecutive reads later than the timeout
+        self.late = None  # Last future that timed out
+        self.backoff_until = 0.0
+        # Temperature and humidity are read together when the device can,
+        # which is known once a device set up in the background is ready
+        self.combined = None
+
+    def _fetch(self, key):
+        """
+        Read the device and return the values by attribute name.
+        """
+        start = monotonic()
+        if key == "temperature_humidity":
+            try:
+                temp, humid = self.device.temperature_humidity
+                values = {
+                    "temperature": (temp, None),
+                    "humidity": (humid, None),
+                    "temperature_humidity": ((temp, humid), None),
+                }
+            except Exception as e:
+                values = {k: (None, e) for k in COMBINED}
+        else:
+            try:
+                values = {key: (getattr(self.device, key), None)}
+            except Exception as e:
+                values = {key: (None, e)}
+        now = monotonic()
+        SENSOR_READ.observe(now - start, self.name)
+        if values[key][1] is not None:
+            SENSOR_FAILURES.inc(self.name, "error")
+        values = {k: (v, exc, now) for k, (v, exc) in values.items()}
+        with self.lock:
+            self.values.update(values)
+            self.pending.pop(key, None)
+            if self.executor is None or now - start <= self.timeout:
+                self.timeouts = 0
+                self.backoff_until = 0.0
+        return values
+
+    def _combined(self):
+        if self.combined is None:
+            device = self.device
+            if isinstance(device, PendingDevice):
+                device = device.ready()
+                if device is None:
+                    return False
+            self.combined = hasattr(type(device), "temperature_humidity")
+        return self.combined
+
+    def read_later(self, attr):
+        """
+        Start reading the attribute and return a function that returns the
+        value, or raises the failure, within the timeout.
+        """
+        key = "temperature_humidity" if self._combined() and attr in COMBINED else attr
+        with self.lock:
+            now = monotonic()
+            try:
+                value, exc, ts = self.values[attr]
+                if now - ts < self.ttl:
+                    future = _done({attr: (value, exc, ts)})
+                    return lambda: self._result(future, attr, now)
+            except KeyError:
+                pass
+            future = self.pending.get(key)
+            if future is not None and future is self.late:
+                # Do not wait again for a read already late
+                e = SensorTimeout('sensor "{}": still reading'.format(self.name))
+                return lambda: self._raise(e)
+            if future is None:
+                if now < self.backoff_until:
+                    e = SensorTimeout(
+                        'sensor "{}": not read for {:.0f}s after {} timeouts'.format(
+                            self.name, self.backoff_until - now, self.timeouts
+                        )
+                    )
+                    return lambda: self._raise(e)
+                self.reads += 1
+                if self.executor is None:
+                    future = _done(self._fetch(key))
+                else:
+                    future = self.executor.submit(self._fetch, key)
+                    self.pending[key] = future
+        return lambda: self._result(future, attr, now)
+
+    def _raise(self, e):
+        raise e
+
+    def _result(self, future, attr, start):
+        try:
+            values = future.result(max(0.0, start + self.timeout - monotonic()))
+        except FutureTimeout:
+            with self.lock:
+                if future is not self.late:
+                    self.late = future
+                    self.timeouts += 1
+                    backoff = min(self.timeout * 2**self.timeouts, self.max_backoff)
+                    self.backoff_until = monotonic() + backoff
+            SENSOR_FAILURES.inc(self.name, "timeout")
+            raise SensorTimeout(
+                'sensor "{}": no answer within {}s'.format(self.name, self.timeout)
+            )
+        value, exc, ts = values[attr]
+        if exc is not None:
+            raise exc
+        return value
+
+    def _read(self, attr):
+        return self.read_later(attr)()
+
+    @property
+    def temperature(self):
+        return self._read("temperature")
+
+    @property
+    def humidity(self):
+        return self._read("humidity")
+
+    @property
+    def temperature_humidity(self):
+        return self._read("temperature_humidity")
+
+
+class SensorHub:
+    """
+    Registry of the sensor devices used by rooms, that gives the same
+    SharedSensor to every room referring to a given device name. Devices are
+    created by `get_device`, the devices library by default.
+    """
+
+    def __init__(
+        self, ttl=5.0, timeout=3.0, workers=4, max_backoff=300.0, get_device=None
+    ):
+        self.get_device = get_device or devices.get_device
+        self.ttl = ttl
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.executor = None
+        if timeout > 0:
+            self.executor = DaemonExecutor(workers, name="sensor-reader")
+        self.lock = Lock()
+        self.sensors = {}
+
+    def get(self, name):
+        """
+        Return the shared sensor for the device name, or None if no name.
+        """
+        if not name:
+            return None
+        with self.lock:
+            try:
+                return self.sensors[name]
+            except KeyError:
+                device = self.get_device(name)
+                if device is None:
+                    return None
+                if self.ttl > 0 or self.executor is not None:
+                    sensor = SharedSensor(
+                        name,
+                        device,
+                        ttl=self.ttl,
+                        executor=self.executor,
+                        timeout=self.timeout,
+                        max_backoff=self.max_backoff,
+                    )
+                    logger.debug(
+                        'sensor "{}": reads shared with a TTL of {}s'.format(
+                            name, self.ttl
+                        )
+                    )
+                else:
+                    sensor = device
+                self.sensors[name] = sensor
+                return sensor
+
+    def forget(self, names):
+        """
+        Drop the sensors of the device names, to be created again from the
+        devices config on next use.
+        """
+        with self.lock:
+            for name in names:
+                self.sensors.pop(name, None)
+
+    def stop(self):
+        """
+        Let the reader threads exit, without waiting for the reads in
+        progress.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
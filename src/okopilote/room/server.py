@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import socket
+import sys
+from io import BytesIO
+from threading import Lock
+from urllib.parse import unquote
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from bottle import ServerAdapter
+
+from .executor import DaemonExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def make_server(name, host, port, **options):
+    """
+    Return the Bottle server adapter for the backend name.
+    """
+    if name == "wsgiref":
+        return name
+    try:
+        adapter = {"threaded": ThreadedServer, "asyncio": AsyncioServer}[name]
+    except KeyError:
+        raise ValueError('Unknown API server: "{}"'.format(name))
+    return adapter(host=host, port=port, **options)
+
+
+class _ServerHandler(ServerHandler):
+    http_version = "1.1"
+
+    def close(self):
+        # Keep the connection only if the client knows the end of the body
+        if self.headers is None or "Content-Length" not in self.headers:
+            self.request_handler.close_connection = True
+        super().close()
+
+
+class _KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    WSGI request handler serving several HTTP/1.1 requests per connection.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = True
+        # A client sending nothing must not hold the worker
+        self.connection.settimeout(self.server.request_timeout)
+        self.handle_one_request()
+        while not self.close_connection:
+            self.connection.settimeout(self.server.keepalive_timeout)
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            self.close_connection = True
+            return
+        self.connection.settimeout(self.server.request_timeout)
+        if not self.parse_request():
+            return
+        handler = _ServerHandler(
+            self.rfile,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=True,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        # Give the worker back when connections are waiting for one
+        if self.server.waiting:
+            self.close_connection = True
+
+
+class _QuietRequestHandler(_KeepAliveRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class _PoolWSGIServer(WSGIServer):
+    """
+    WSGI server whose connections are handled by a bounded pool of threads.
+    """
+
+    def __init__(self, address, handler, workers, request_timeout, keepalive_timeout):
+        super().__init__(address, handler)
+        self.pool = DaemonExecutor(workers, name="api-worker")
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.waiting = 0
+        self.waiting_lock = Lock()
+
+    def process_request(self, request, client_address):
+        with self.waiting_lock:
+            self.waiting += 1
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        with self.waiting_lock:
+            self.waiting -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class ThreadedServer(ServerAdapter):
+    """
+    Server with a bounded pool of worker threads, HTTP/1.1 keep-alive and
+    request timeouts. Options: workers, request_timeout, keepalive_timeout.
+    """
+
+    def run(self, handler):
+        server = _PoolWSGIServer(
+            (self.host, self.port),
+            _QuietRequestHandler if self.quiet else _KeepAliveRequestHandler,
+            workers=self.options.get("workers", 8),
+            request_timeout=self.options.get("request_timeout", 30.0),
+            keepalive_timeout=self.options.get("keepalive_timeout", 5.0),
+        )
+        server.set_app(handler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+class AsyncioServer(ServerAdapter):
+    """
+    Server reading and writing connections from an asyncio loop, the WSGI
+    application being run by a bounded pool of threads. Responses without a
+    known length are sent chunked to HTTP/1.1 clients, so that connections
+    stay open. Options: workers, request_timeout, keepalive_timeout.
+    """
+
+    def run(self, handler):
+        self.app = handler
+        self.workers = self.options.get("workers", 8)
+        self.request_timeout = self.options.get("request_timeout", 30.0)
+        self.keepalive_timeout = self.options.get("keepalive_timeout", 5.0)
+        loop = asyncio.new_event_loop()
+        self.executor = DaemonExecutor(self.workers, name="api-worker")
+        try:
+            server = loop.run_until_complete(
+                asyncio.start_server(self._client, self.host, self.port)
+            )
+            loop.run_until_complete(server.serve_forever())
+        finally:
+            loop.close()
+
+    async def _client(self, reader, writer):
+        try:
+            timeout = self.request_timeout
+            while await self._request(reader, writer, timeout):
+                timeout = self.keepalive_timeout
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.exception("API server: failed to handle the request")
+        finally:
+            writer.close()
+
+    async def _request(self, reader, writer, timeout):
+        """
+        Serve one request. Return True if the connection may be reused.
+        """
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if not line:
+            return False
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+            return False
+        headers = []
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.request_timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers.append((name.strip(), value.strip()))
+        environ = self._environ(method, target, version, headers)
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = b""
+        if length:
+            body = await asyncio.wait_for(
+                reader.readexactly(length), self.request_timeout
+            )
+        environ["wsgi.input"] = BytesIO(body)
+
+        loop = asyncio.get_running_loop()
+        parts = asyncio.Queue()
+        closed = []
+        # The application and the iteration of its response run in the same
+        # worker thread, since Bottle keeps the response in a thread local
+        self.executor.submit(self._produce, loop, parts, closed, environ)
+        try:
+            kind, *args = await parts.get()
+            if kind == "error":
+                raise args[0]
+            status, response_headers = args
+            names = {k.lower() for k, v in response_headers}
+            conn = environ.get("HTTP_CONNECTION", "").lower()
+            keep = version == "HTTP/1.1" and conn != "close"
+            chunked = keep and "content-length" not in names
+            if not chunked and "content-length" not in names:
+                keep = False
+            head = ["HTTP/1.1 {}".format(status)]
+            head += ["{}: {}".format(k, v) for k, v in response_headers]
+            if chunked:
+                head.append("Transfer-Encoding: chunked")
+            if not keep:
+                head.append("Connection: close")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            while True:
+                kind, *args = await parts.get()
+                if kind == "error":
+                    raise args[0]
+                if kind == "end":
+                    break
+                if chunked:
+                    writer.write(b"%x\r\n%s\r\n" % (len(args[0]), args[0]))
+                else:
+                    writer.write(args[0])
+                await writer.drain()
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            # Tell the worker to stop iterating a response nobody reads
+            closed.append(True)
+        return keep
+
+    def _produce(self, loop, parts, closed, environ):
+        """
+        Run the application in a worker thread and hand the status, headers
+        and body chunks over to the loop.
+        """
+
+        def put(*part):
+            loop.call_soon_threadsafe(parts.put_nowait, part)
+
+        started = []
+
+        def start_response(status, response_headers, exc_info=None):
+            started[:] = [status, response_headers]
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                headers_sent = False
+                for chunk in result:
+                    if closed:
+                        return
+                    if not headers_sent:
+                        put("start", *started)
+                        headers_sent = True
+                    if chunk:
+                        put("data", chunk)
+                if not headers_sent:
+                    put("start", *started)
+                put("end")
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        except Exception as e:
+            put("error", e)
+
+    def _environ(self, method, target, version, headers):
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, "iso-8859-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers:
+            key = name.upper().replace("-", "_")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+            elif "HTTP_" + key in environ:
+                environ["HTTP_" + key] += "," + value
+            else:
+                environ["HTTP_" + key] = value
+        return environ
@@ -0,0 +1,713 @@
+import json
+import logging
+import multiprocessing
+import struct
+from itertools import count
+from math import isnan, nan
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+
+from .app import App, _device_deps, _room_devices
+from .executor import DaemonExecutor
+from .room import Room
+from .snapshot import RoomSnapshot
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks of the state table by the API process
+POLL_INTERVAL = 0.05
+# Seconds before a worker process that has exited is started again
+RESTART_DELAY = 10.0
+# Reads of a row being written before giving up, its writer having died
+READ_RETRIES = 10000
+
+FLOAT_FIELDS = (
+    "temp",
+    "temp_predict",
+    "temp_set",
+    "temp_set_offset",
+    "temp_deviation",
+    "humid",
+    "heat_demand_weight",
+)
+FLAG_FIELDS = ("temp_controlled", "valve_order", "wind_opened", "is_alive")
+BOOL_FIELDS = ("temp_controlled", "wind_opened", "is_alive")
+# Row of a room: sequence number, floats (NaN for None), flags (-1 for None)
+# and the length of the JSON of the errors and scheduler mode that follows
+ROW = struct.Struct("<I" + "d" * len(FLOAT_FIELDS) + "b" * len(FLAG_FIELDS) + "H")
+EXTRA_SIZE = 1024
+ROW_SIZE = (ROW.size + EXTRA_SIZE + 7) // 8 * 8
+SEQ = struct.Struct("<I")
+# Change counter of each worker, in the header of the table
+COUNTER = struct.Struct("<Q")
+
+# Calls the API process can make to a room of a worker, by attribute path
+ROOM_CALLS = {
+    "dump",
+    "history_query",
+    "push_temp_set_offset",
+    "set_temp_set",
+    "stop",
+    "temp_set",
+    "temperature_deviation",
+    "profiler.cprofile_remaining",
+    "profiler.disable",
+    "profiler.enable",
+    "profiler.enabled",
+    "profiler.request_cprofile",
+    "profiler.stats",
+    "sched.disable_weekly",
+    "sched.enable_weekly",
+    "sched.summary",
+    "sched.weekly_enabled",
+}
+# Calls run by a pool of threads of the worker, so that they do not hold up
+# the other calls while reading files or building large answers
+LONG_CALLS = {"dump", "history_query", "profiler.stats"}
+# Threads of a worker for the long calls
+CALL_THREADS = 4
+
+
+def assign_shards(room_confs, device_confs, boards, count):
+    """
+    Return the lists of room ids of `count` shards. Rooms sharing a device,
+    or a relay board, are in the same shard, so that a device is driven by a
+    single process. Groups of rooms are spread from the largest one to the
+    least loaded shard.
+    """
+    parent = {}
+
+    def find(k):
+        while parent.setdefault(k, k) != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    for room_id, conf in room_confs.items():
+        keys = set()
+        for name in _room_devices(conf):
+            keys |= _device_deps(name, device_confs)
+        keys |= {("board", boards[k]) for k in keys if k in boards}
+        for k in keys:
+            parent[find(("device", k) if isinstance(k, str) else k)] = find(room_id)
+    groups = {}
+    for room_id in room_confs:
+        groups.setdefault(find(room_id), []).append(room_id)
+    shards = [[] for i in range(count)]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(shards, key=len).extend(group)
+    return [s for s in shards if s]
+
+
+class StateTable:
+    """
+    Fixed-layout table of the room states in shared memory. Each room row is
+    written by one worker process and read by the API process without any
+    round-trip. A row is guarded by a sequence number, odd while the row is
+    being written, so that readers retry instead of reading a torn row.
+    """
+
+    def __init__(self, room_ids, workers, name=None):
+        from multiprocessing import shared_memory
+
+        self.room_ids = list(room_ids)
+        self.rows = {k: i for i, k in enumerate(self.room_ids)}
+        self.header_size = COUNTER.size * workers
+        size = self.header_size + ROW_SIZE * len(self.room_ids)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+        self.name = self.shm.name
+        self.lock = Lock()
+        self.seqs = {}
+        self.counter = 0
+
+    def _offset(self, room_id):
+        return self.header_size + ROW_SIZE * self.rows[room_id]
+
+    def write(self, snapshot, worker):
+        """
+        Write the snapshot in the row of its room, then bump the change
+        counter of the worker.
+        """
+        extra = {"errors": list(snapshot.errors), "mode": snapshot.sched_curr_mode}
+        data = json.dumps(extra, default=str).encode()
+        if len(data) > EXTRA_SIZE:
+            extra["errors"] = ["{} errors, not shown".format(len(snapshot.errors))]
+            data = json.dumps(extra, default=str).encode()
+        floats = [getattr(snapshot, k) for k in FLOAT_FIELDS]
+        flags = [getattr(snapshot, k) for k in FLAG_FIELDS]
+        offset = self._offset(snapshot.room_id)
+        with self.lock:
+            try:
+                seq = self.seqs[snapshot.room_id] + 1
+            except KeyError:
+                # Go on from the row of a previous worker, even if torn
+                seq = self.seq(snapshot.room_id)
+                seq += 1 if seq % 2 == 0 else 2
+            ROW.pack_into(
+                self.buf,
+                offset,
+                seq,
+                *(nan if v is None else v for v in floats),
+                *(-1 if v is None else int(v) for v in flags),
+                len(data),
+            )
+            self.buf[offset + ROW.size : offset + ROW.size + len(data)] = data
+            SEQ.pack_into(self.buf, offset, seq + 1)
+            self.seqs[snapshot.room_id] = seq + 1
+            self.counter += 1
+            COUNTER.pack_into(self.buf, COUNTER.size * worker, self.counter)
+
+    def counters(self):
+        return bytes(self.buf[: self.header_size])
+
+    def seq(self, room_id):
+        return SEQ.unpack_from(self.buf, self._offset(room_id))[0]
+
+    def read(self, room_id, retries=None):
+        """
+        Return the sequence number and the state dict of the room, or None if
+        the room has not been written yet, or is still being written after
+        the given number of retries.
+        """
+        offset = self._offset(room_id)
+        while True:
+            seq = SEQ.unpack_from(self.buf, offset)[0]
+            if seq == 0:
+                return 0, None
+            if seq % 2:
+                if retries is not None:
+                    if retries <= 0:
+                        return seq, None
+                    retries -= 1
+                sleep(0)
+                continue
+            row = bytes(self.buf[offset : offset + ROW_SIZE])
+            if SEQ.unpack_from(self.buf, offset)[0] == seq:
+                break
+        values = ROW.unpack_from(row)
+        n = len(FLOAT_FIELDS)
+        state = {
+            k: None if isnan(v) else v for k, v in zip(FLOAT_FIELDS, values[1 : n + 1])
+        }
+        for k, v in zip(FLAG_FIELDS, values[n + 1 : -1]):
+            state[k] = None if v == -1 else (bool(v) if k in BOOL_FIELDS else v)
+        extra = json.loads(row[ROW.size : ROW.size + values[-1]].decode())
+        state["errors"] = extra["errors"]
+        state["sched_curr_mode"] = extra["mode"]
+        return seq, state
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _serve(room_id, path, args):
+    """
+    Return the answer to a call of the API process: ("ok", result) or
+    ("error", exception type name, message).
+    """
+    try:
+        if room_id is None:
+            if path != "push_circulator_state":
+                raise ValueError("Unknown call: {}".format(path))
+            result = Room.push_circulator_state(*args)
+        else:
+            if path not in ROOM_CALLS:
+                raise ValueError("Unknown call: {}".format(path))
+            result = App.rooms[room_id]
+            for attr in path.split("."):
+                result = getattr(result, attr)
+            if callable(result):
+                result = result(*args)
+        # Sent as the API would serialize it
+        return ("ok", json.loads(json.dumps(result, default=str)))
+    except Exception as e:
+        return ("error", type(e).__name__, str(e))
+
+
+def _worker_main(config_file, room_ids, all_ids, index, workers, name, conn, level):
+    """
+    Run the rooms of a shard, publishing their snapshots in the state table,
+    and serve the calls of the API process until told to exit. A call comes
+    with an id, None if no answer is expected, sent back with its answer.
+    """
+    logging.basicConfig(
+        level=level, format="[%(levelname)s] %(processName)s: %(message)s"
+    )
+    table = StateTable(all_ids, workers, name=name)
+    Room.on_publish = staticmethod(lambda snapshot: table.write(snapshot, index))
+    App.config_file = config_file
+    App.room_ids = room_ids
+    send_lock = Lock()
+    executor = DaemonExecutor(CALL_THREADS, name="calls")
+
+    def serve(call_id, room_id, path, args):
+        answer = _serve(room_id, path, args)
+        if call_id is not None:
+            with send_lock:
+                conn.send((call_id, answer))
+
+    try:
+        App._init()
+        while True:
+            try:
+                call_id, room_id, path, args = conn.recv()
+            except EOFError:
+                # The API process is gone
+                break
+            if path == "exit":
+                break
+            if path in LONG_CALLS:
+                executor.submit(serve, call_id, room_id, path, args)
+            else:
+                serve(call_id, room_id, path, args)
+    finally:
+        App._stop()
+        Room.on_publish = None
+        table.close()
+
+
+class WorkerExited(OSError):
+    """
+    The worker process of a room is not running.
+    """
+
+
+class ShardWorker:
+    """
+    Handle of a worker process, with the pipe used to call its rooms. The
+    answers are received by a thread and given to the calls by id, so that
+    concurrent calls do not wait for each other.
+    """
+
+    def __init__(self, index, room_ids):
+        self.index = index
+        self.room_ids = room_ids
+        self.process = None
+        self.conn = None
+        self.lock = Lock()  # Of the waiters
+        self.send_lock = Lock()
+        self.ids = count()
+        self.waiters = {}  # Call id -> [Event, answer]
+        self.exited = False
+        self.exited_at = None
+        self.start_args = None
+
+    def start(self, context, config_file, all_ids, workers, table_name):
+        self.start_args = (context, config_file, all_ids, workers, table_name)
+        self.exited = False
+        self.exited_at = None
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            name="rooms-{}".format(self.index),
+            args=(
+                config_file,
+                self.room_ids,
+                all_ids,
+                self.index,
+                workers,
+                table_name,
+                child,
+                logging.getLogger().getEffectiveLevel(),
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        Thread(
+            target=self._receive,
+            args=(self.conn,),
+            name="{}-answers".format(self.process.name),
+            daemon=True,
+        ).start()
+
+    def _receive(self, conn):
+        while True:
+            try:
+                call_id, answer = conn.recv()
+            except (OSError, EOFError) as e:
+                # The process is gone: fail the pending calls
+                with self.lock:
+                    waiters = [w for w in self.waiters.values() if w[1] is None]
+                    for waiter in waiters:
+                        waiter[1] = ("exited", str(e) or "connection closed")
+                        waiter[0].set()
+                return
+            with self.lock:
+                waiter = self.waiters.get(call_id)
+            if waiter is not None:
+                waiter[1] = answer
+                waiter[0].set()
+
+    def restart(self):
+        """
+        Start again the process, once it has exited.
+        """
+        with self.send_lock:
+            self.process.join()
+            self.conn.close()
+            self.start(*self.start_args)
+        logger.warning("{}: restarted".format(self.process.name))
+
+    def running(self):
+        return not self.exited and self.process.is_alive()
+
+    def _failed(self, e):
+        return WorkerExited(
+            "Worker process {} is not running: {}".format(self.process.name, e)
+        )
+
+    def send(self, room_id, path, *args):
+        """
+        Send a call without waiting for its result. The call is dropped if
+        the worker is not running.
+        """
+        if not self.running():
+            return
+        try:
+            with self.send_lock:
+                self.conn.send((None, room_id, path, args))
+        except OSError as e:
+            logger.warning(self._failed(e))
+
+    def call(self, room_id, path, *args):
+        """
+        Call a room of the worker and return the result. Raise WorkerExited
+        if the worker is not running.
+        """
+        if not self.running():
+            raise self._failed("exited")
+        waiter = [Event(), None]
+        with self.lock:
+            call_id = next(self.ids)
+            self.waiters[call_id] = waiter
+        try:
+            with self.send_lock:
+                self.conn.send((call_id, room_id, path, args))
+            waiter[0].wait()
+        except OSError as e:
+            raise self._failed(e)
+        finally:
+            with self.lock:
+                self.waiters.pop(call_id, None)
+        answer = waiter[1]
+        if answer[0] == "exited":
+            raise self._failed(answer[1])
+        if answer[0] == "ok":
+            return answer[1]
+        exc = {"KeyError": KeyError, "ValueError": ValueError}.get(
+            answer[1], RuntimeError
+        )
+        raise exc(answer[2])
+
+    def stop(self, timeout=10.0):
+        self.send(None, "exit")
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning("{}: still running, terminated".format(self.process.name))
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class _RemoteScheduler:
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    @property
+    def weekly_enabled(self):
+        return self.proxy.call("sched.weekly_enabled")
+
+    def enable_weekly(self):
+        return self.proxy.call("sched.enable_weekly")
+
+    def disable_weekly(self):
+        return self.proxy.call("sched.disable_weekly")
+
+    def summary(self):
+        return self.proxy.call("sched.summary")
+
+
+class _RemoteProfiler:
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    @property
+    def enabled(self):
+        return self.proxy.call("profiler.enabled")
+
+    @property
+    def cprofile_remaining(self):
+        return self.proxy.call("profiler.cprofile_remaining")
+
+    def enable(self):
+        return self.proxy.call("profiler.enable")
+
+    def disable(self):
+        return self.proxy.call("profiler.disable")
+
+    def stats(self):
+        return self.proxy.call("profiler.stats")
+
+    def request_cprofile(self, ticks):
+        return self.proxy.call("profiler.request_cprofile", ticks)
+
+
+class RoomProxy:
+    """
+    Room of a worker process, as seen by the API process: the snapshot is
+    read from the state table, the other calls are sent to the worker.
+    """
+
+    def __init__(self, room_id, label, worker, mirror):
+        self.room_id = room_id
+        self.label = label
+        self.worker = worker
+        self.mirror = mirror
+        self.sched = _RemoteScheduler(self)
+        self.profiler = _RemoteProfiler(self)
+
+    @property
+    def snapshot(self):
+        return self.mirror.snapshot(self.room_id)
+
+    @property
+    def temp_set(self):
+        return self.call("temp_set")
+
+    def call(self, path, *args):
+        """
+        Call the room in its worker. The calls to a room whose worker is not
+        running return None, so that commands to all the rooms go on with
+        the other workers. The error is in the snapshot of the room.
+        """
+        try:
+            return self.worker.call(self.room_id, path, *args)
+        except WorkerExited as e:
+            logger.debug('"{}": {}'.format(self.room_id, e))
+            return None
+
+    def is_alive(self):
+        return self.snapshot.is_alive
+
+    def push_temp_set_offset(self, offset):
+        self.worker.send(self.room_id, "push_temp_set_offset", offset)
+
+    def temperature_deviation(self, setpoint_offset=None):
+        return self.call("temperature_deviation", setpoint_offset)
+
+    def set_temp_set(self, T):
+        return self.worker.call(self.room_id, "set_temp_set", T)
+
+    def history_query(self, from_=None, to=None, step=None):
+        return self.call("history_query", from_, to, step)
+
+    def dump(self):
+        return self.call("dump")
+
+    def stop(self):
+        return self.call("stop")
+
+
+class StateMirror:
+    """
+    Snapshots of the API process, made from the rows of the state table.
+    A row is decoded only when its sequence number has changed, and the
+    snapshot is then stamped with a version of this process, which wakes up
+    the event streams. A thread checks the table for the waiters, and starts
+    again the workers that have exited.
+    """
+
+    def __init__(self, table, labels, workers):
+        self.table = table
+        self.labels = labels
+        self.workers = workers
+        self.lock = Lock()
+        self.seqs = {}
+        self.frozen = set()  # Rooms of the workers that have exited
+        # Sequence number of the rows found being written for too long, like
+        # by a worker killed in the middle, left as is until written again
+        self.torn = {}
+        self.snapshots = {}
+        self.stopped = Event()
+        self.thread = None
+        self.refresh_all()
+
+    def _decode(self, room_id, state, is_alive=None, error=None):
+        state = dict(state or {k: None for k in FLOAT_FIELDS + FLAG_FIELDS})
+        state.setdefault("errors", [])
+        state.setdefault("sched_curr_mode", None)
+        state["room_id"] = room_id
+        state["label"] = self.labels[room_id]
+        if is_alive is not None:
+            state["is_alive"] = is_alive
+        if error is not None:
+            state["errors"] = list(state["errors"]) + [error]
+        return RoomSnapshot.from_dict(state)
+
+    def _update(self, room_id, snapshot):
+        old = self.snapshots.get(room_id)
+        if not snapshot.same_state(old):
+            snapshot.stamp()
+            self.snapshots[room_id] = snapshot
+
+    def refresh(self, room_id):
+        if self.stopped.is_set() or room_id in self.frozen:
+            return
+        seq = self.table.seq(room_id)
+        if seq == self.seqs.get(room_id) or seq == self.torn.get(room_id):
+            return
+        # Read out of the lock, a row being written making the read retry
+        seq, state = self.table.read(room_id, retries=READ_RETRIES)
+        with self.lock:
+            if self.stopped.is_set() or room_id in self.frozen:
+                return
+            if seq % 2:
+                logger.warning('"{}": state row left being written'.format(room_id))
+                self.torn[room_id] = seq
+                if room_id not in self.snapshots:
+                    self._update(room_id, self._decode(room_id, None, is_alive=False))
+                return
+            self.torn.pop(room_id, None)
+            if seq <= self.seqs.get(room_id, -1) and seq != 0:
+                # Read by a concurrent refresh already
+                return
+            self.seqs[room_id] = seq
+            alive = None if state else False
+            self._update(room_id, self._decode(room_id, state, is_alive=alive))
+
+    def refresh_all(self):
+        for room_id in self.table.room_ids:
+            self.refresh(room_id)
+
+    def snapshot(self, room_id):
+        self.refresh(room_id)
+        return self.snapshots[room_id]
+
+    def _loop(self):
+        counters = None
+        while not self.stopped.wait(POLL_INTERVAL):
+            new = self.table.counters()
+            if new != counters:
+                counters = new
+                self.refresh_all()
+            for worker in self.workers:
+                if not worker.exited and not worker.process.is_alive():
+                    self._freeze(worker)
+                elif (
+                    worker.exited
+                    and monotonic() - worker.exited_at >= RESTART_DELAY
+                    and not self.stopped.is_set()
+                ):
+                    self._restart(worker)
+
+    def _freeze(self, worker):
+        """
+        Keep the last states of the rooms of an exited worker, marked as not
+        alive with the error.
+        """
+        worker.exited = True
+        worker.exited_at = monotonic()
+        msg = "Worker process exited with code {}".format(worker.process.exitcode)
+        logger.error("{}: {}".format(worker.process.name, msg))
+        states = {
+            k: self.table.read(k, retries=READ_RETRIES)[1] for k in worker.room_ids
+        }
+        with self.lock:
+            for room_id, state in states.items():
+                if state is None and room_id in self.snapshots:
+                    # Row left being written: the last state read
+                    state = self.snapshots[room_id].to_dict()
+                self._update(
+                    room_id,
+                    self._decode(room_id, state, is_alive=False, error=msg),
+                )
+                self.frozen.add(room_id)
+
+    def _restart(self, worker):
+        try:
+            worker.restart()
+        except Exception as e:
+            logger.error("{}: failed to restart: {}".format(worker.process.name, e))
+            worker.exited_at = monotonic()
+            return
+        with self.lock:
+            # The rooms are frozen until their first state from the new worker
+            for room_id in worker.room_ids:
+                self.frozen.discard(room_id)
+
+    def start(self):
+        self.thread = Thread(target=self._loop, name="state-mirror", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the thread. The last snapshots are kept, the table being no
+        longer read.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class Shards:
+    """
+    Rooms split across worker processes, so that a large installation uses
+    all the cores: each worker runs the rooms of its shard and writes their
+    states in a shared-memory table, read by the API process.
+    """
+
+    def __init__(self, config_file, room_confs, device_confs, boards, processes):
+        self.config_file = config_file
+        self.room_ids = list(room_confs)
+        shards = assign_shards(room_confs, device_confs, boards, processes)
+        self.workers = [ShardWorker(i, ids) for i, ids in enumerate(shards)]
+        self.table = StateTable(self.room_ids, len(self.workers))
+        self.mirror = None
+        labels = {k: conf.get("label", "") for k, conf in room_confs.items()}
+        self.labels = labels
+        self.rooms = {}
+
+    def start(self):
+        # Spawned, so that workers do not inherit the threads of this process
+        context = multiprocessing.get_context("spawn")
+        for worker in self.workers:
+            worker.start(
+                context,
+                self.config_file,
+                self.room_ids,
+                len(self.workers),
+                self.table.name,
+            )
+            logger.info(
+                "{}: {} room(s)".format(worker.process.name, len(worker.room_ids))
+            )
+        self.mirror = StateMirror(self.table, self.labels, self.workers)
+        self.mirror.start()
+        owner = {k: w for w in self.workers for k in w.room_ids}
+        self.rooms = {
+            k: RoomProxy(k, self.labels[k], owner[k], self.mirror)
+            for k in self.room_ids
+        }
+
+    def broadcast(self, path, *args):
+        """
+        Send a call to every worker, like a circulator state.
+        """
+        for worker in self.workers:
+            if not worker.exited:
+                worker.send(None, path, *args)
+
+    def stop(self):
+        if self.mirror is not None:
+            self.mirror.stop()
+        for worker in self.workers:
+            worker.stop()
+        self.table.close(unlink=True)
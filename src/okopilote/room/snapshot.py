@@ -0,0 +1,184 @@
+import json
+from itertools import count
+from threading import Condition
+from time import monotonic
+
+# Room attributes published in snapshots
+FIELDS = (
+    "room_id",
+    "label",
+    "temp",
+    "temp_predict",
+    "temp_set",
+    "temp_set_offset",
+    "temp_deviation",
+    "temp_controlled",
+    "humid",
+    "valve_order",
+    "wind_opened",
+    "heat_demand_weight",
+)
+
+
+class RoomSnapshot:
+    """
+    Immutable state of a room, published at the end of each tick so that
+    readers never see a half-updated room. Versions come from a process-wide
+    counter, hence a newer snapshot of any room has a greater version. The
+    JSON body is serialized once, on first use.
+
+    A snapshot is versioned by `stamp` only when it differs from the
+    previous one, so that versions move only when the state changes.
+    """
+
+    __slots__ = FIELDS + ("errors", "is_alive", "sched_curr_mode", "version", "_body")
+
+    versions = count(1)
+
+    def __init__(self, room, is_alive, sched_curr_mode):
+        set_ = object.__setattr__
+        for name in FIELDS:
+            set_(self, name, getattr(room, name))
+        set_(self, "errors", tuple(str(e) for e in room.errors))
+        set_(self, "is_alive", is_alive)
+        set_(self, "sched_curr_mode", sched_curr_mode)
+        set_(self, "version", None)
+        set_(self, "_body", None)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Return an unversioned snapshot of the state returned by to_dict, like
+        the one of a room run by another process.
+        """
+        snapshot = cls.__new__(cls)
+        set_ = object.__setattr__
+        for name in FIELDS:
+            set_(snapshot, name, data[name])
+        set_(snapshot, "errors", tuple(data["errors"]))
+        set_(snapshot, "is_alive", data["is_alive"])
+        set_(snapshot, "sched_curr_mode", data["sched_curr_mode"])
+        set_(snapshot, "version", None)
+        set_(snapshot, "_body", None)
+        return snapshot
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshots are immutable")
+
+    def same_state(self, other):
+        """
+        Return True if the other snapshot holds the same state.
+        """
+        return other is not None and all(
+            getattr(self, name) == getattr(other, name)
+            for name in FIELDS + ("errors", "is_alive", "sched_curr_mode")
+        )
+
+    def stamp(self):
+        """
+        Give the snapshot its version and wake up the waiters.
+        """
+        object.__setattr__(self, "version", next(self.versions))
+        with published:
+            published.notify_all()
+
+    def temperature_deviation(self, setpoint_offset=0.0):
+        """
+        Deviation of the published temperature from the setpoint plus the
+        offset, like Room.temperature_deviation.
+        """
+        if self.wind_opened:
+            return None
+        try:
+            return round(
+                round(self.temp_predict - self.temp_set, 1) - setpoint_offset, 1
+            )
+        except TypeError:
+            return None
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in FIELDS}
+        data["errors"] = list(self.errors)
+        data["is_alive"] = self.is_alive
+        data["sched_curr_mode"] = self.sched_curr_mode
+        return data
+
+    @property
+    def body(self):
+        """
+        The snapshot serialized in JSON.
+        """
+        if self._body is None:
+            object.__setattr__(self, "_body", json.dumps(self.to_dict(), default=str))
+        return self._body
+
+
+# Notified each time a snapshot is stamped
+published = Condition()
+
+
+def wait_newer(get_snapshots, version, timeout):
+    """
+    Wait until one of the snapshots returned by get_snapshots() is newer than
+    the version, or until the timeout. Return the last snapshots.
+    """
+    deadline = monotonic() + timeout
+    with published:
+        while True:
+            snapshots = get_snapshots()
+            remaining = deadline - monotonic()
+            if remaining <= 0 or any(s.version > version for s in snapshots):
+                return snapshots
+            published.wait(remaining)
+
+
+def etag(snapshots):
+    """
+    Return the entity tag of a list of snapshots.
+    """
+    return '"{}-{}"'.format(
+        len(snapshots), max((s.version for s in snapshots), default=0)
+    )
+
+
+def heat_demand(snapshots, offsets):
+    """
+    Return the deviations of the snapshots by room id, computed with the
+    setpoint offsets by room id, and the heat demand summary of the rooms:
+    worst deviation, number of rooms calling for heat and demand, the sum of
+    the missing degrees weighted by the heat_demand_weight of the rooms.
+    Rooms without an offset keep the deviation computed with the offset they
+    use, pushed before or their default one.
+    """
+    deviations = {}
+    worst = None
+    calling = 0
+    demand = 0.0
+    for s in snapshots:
+        if s.room_id in offsets:
+            dev = s.temperature_deviation(offsets[s.room_id])
+        else:
+            dev = s.temp_deviation
+        deviations[s.room_id] = dev
+        if dev is None:
+            continue
+        if worst is None or dev < worst:
+            worst = dev
+        if dev < 0:
+            calling += 1
+            demand -= dev * s.heat_demand_weight
+    summary = {
+        "worst_deviation": worst,
+        "calling_for_heat": calling,
+        "weighted_demand": round(demand, 2),
+    }
+    return deviations, summary
+
+
+def join_bodies(snapshots):
+    """
+    Return the JSON object of the snapshots by room id, from their bodies.
+    """
+    return "{{{}}}".format(
+        ", ".join("{}: {}".format(json.dumps(s.room_id), s.body) for s in snapshots)
+    )
@@ -0,0 +1,204 @@
+from array import array
+from math import isnan, nan
+
+
+class RollingSample:
+    """
+    Fixed size window of measures, None being a missing measure, whose
+    statistics are updated as measures are pushed and evicted. Every
+    operation costs the same whatever the size of the window.
+
+    The maximal drop (greatest fall from a measure to a later one) is kept by
+    a queue made of two stacks of partial aggregates. The least-squares line
+    of the measures against their rank is kept from running sums, ranks being
+    rebased each time the window wraps to preserve precision.
+    """
+
+    __slots__ = (
+        "maxlen",
+        "values",
+        "pos",
+        "pushes",
+        "sum",
+        "count",
+        "last",
+        "last_push",
+        "base",
+        "sx",
+        "sxx",
+        "sxy",
+        "back",
+        "back_max",
+        "back_min",
+        "back_drop",
+        "front_max",
+        "front_min",
+        "front_drop",
+    )
+
+    def __init__(self, maxlen):
+        if maxlen < 1:
+            raise ValueError("Sample size must be at least 1: {}".format(maxlen))
+        self.maxlen = maxlen
+        self.values = array("d", [nan]) * maxlen
+        self.pos = 0
+        self.pushes = 0
+        self.sum = 0.0
+        self.count = 0
+        self.last = None
+        self.last_push = -1
+        # Sums for the linear regression, with x = push number - base
+        self.base = 0
+        self.sx = self.sxx = self.sxy = 0.0
+        # Newest valid measures, with the aggregate of them all
+        self.back = array("d")
+        self.back_max = self.back_min = self.back_drop = nan
+        # Oldest valid measures, the top aggregating the whole front stack
+        self.front_max = array("d")
+        self.front_min = array("d")
+        self.front_drop = array("d")
+
+    def __len__(self):
+        return min(self.pushes, self.maxlen)
+
+    def __iter__(self):
+        """
+        Iterate over the measures, from the oldest to the newest.
+        """
+        n = len(self)
+        for i in range(self.pos - n, self.pos):
+            v = self.values[i % self.maxlen]
+            yield None if isnan(v) else v
+
+    def __repr__(self):
+        return "RollingSample({}, maxlen={})".format(list(self), self.maxlen)
+
+    def append(self, value):
+        if self.pushes >= self.maxlen:
+            self._evict(self.values[self.pos])
+        if value is None:
+            self.values[self.pos] = nan
+        else:
+            value = float(value)
+            self.values[self.pos] = value
+            self.sum += value
+            self.count += 1
+            self.last = value
+            self.last_push = self.pushes
+            x = self.pushes - self.base
+            self.sx += x
+            self.sxx += x * x
+            self.sxy += x * value
+            self._enqueue(value)
+        self.pushes += 1
+        self.pos += 1
+        if self.pos == self.maxlen:
+            self.pos = 0
+            self._rebase()
+
+    def clear(self):
+        self.__init__(self.maxlen)
+
+    def mean(self):
+        """
+        Return the mean of the valid measures, or None if there is none.
+        """
+        if self.count:
+            return self.sum / self.count
+        return None
+
+    def regression(self):
+        """
+        Return the (slope, intercept) of the least-squares line of the valid
+        measures, x being the rank of the measure and 0 the newest one, or
+        None if it cannot be computed.
+        """
+        n = self.count
+        den = n * self.sxx - self.sx * self.sx
+        if n < 2 or den <= 0:
+            return None
+        slope = (n * self.sxy - self.sx * self.sum) / den
+        intercept = (self.sum - slope * self.sx) / n
+        # Move the origin to the newest measure
+        return (slope, intercept + slope * (self.pushes - 1 - self.base))
+
+    def predict(self, steps):
+        """
+        Extrapolate the measure expected the given number of steps after the
+        newest one, or return None if it cannot be computed.
+        """
+        fit = self.regression()
+        if fit is None:
+            return None
+        return fit[1] + fit[0] * steps
+
+    def max_drop(self):
+        """
+        Return the greatest fall from a measure to a later one, or None if
+        there are less than two valid measures.
+        """
+        if self.count < 2:
+            return None
+        if not self.front_drop:
+            return self.back_drop
+        drop = self.front_drop[-1]
+        if self.back:
+            drop = max(drop, self.back_drop, self.front_max[-1] - self.back_min)
+        return drop
+
+    def _evict(self, value):
+        if isnan(value):
+            return
+        self.sum -= value
+        self.count -= 1
+        x = self.pushes - self.maxlen - self.base
+        self.sx -= x
+        self.sxx -= x * x
+        self.sxy -= x * value
+        if self.last_push <= self.pushes - self.maxlen:
+            self.last = None
+        self._dequeue()
+
+    def _rebase(self):
+        """
+        Recompute the running sums from the window, which cancels their
+        rounding errors, with ranks relative to the next push.
+        """
+        self.base = self.pushes
+        self.sum = self.sx = self.sxx = self.sxy = 0.0
+        for i, v in enumerate(self.values):
+            if not isnan(v):
+                x = i - self.maxlen
+                self.sum += v
+                self.sx += x
+                self.sxx += x * x
+                self.sxy += x * v
+
+    def _enqueue(self, value):
+        if self.back:
+            self.back_drop = max(self.back_drop, self.back_max - value)
+            self.back_max = max(self.back_max, value)
+            self.back_min = min(self.back_min, value)
+        else:
+            self.back_max = self.back_min = value
+            self.back_drop = -float("inf")
+        self.back.append(value)
+
+    def _dequeue(self):
+        if not self.front_drop:
+            # Move back measures to the front stack, newest first
+            for v in reversed(self.back):
+                if self.front_drop:
+                    lmax, lmin = self.front_max[-1], self.front_min[-1]
+                    self.front_drop.append(max(self.front_drop[-1], v - lmin))
+                    self.front_max.append(max(lmax, v))
+                    self.front_min.append(min(lmin, v))
+                else:
+                    self.front_drop.append(-float("inf"))
+                    self.front_max.append(v)
+                    self.front_min.append(v)
+            self.back = array("d")
+            self.back_max = self.back_min = self.back_drop = nan
+        self.front_max.pop()
+        self.front_min.pop()
+        self.front_drop.pop()
@@ -0,0 +1,84 @@
+from math import floor
+from time import monotonic
+
+
+class Ticker:
+    """
+    Deadlines of a periodic task, on a grid of the monotonic clock: the
+    deadlines are phase * period + k * period, so that the period does not
+    drift with the duration of the ticks, and tasks of the same period with
+    different phases are spread over the period. Ticks missed because of a
+    late tick are skipped rather than run in a burst.
+
+    Lateness (start of a tick after its deadline) and overruns (ticks longer
+    than the period) are recorded.
+    """
+
+    def __init__(self, period, phase=0.0):
+        self.period = period
+        self.offset = (phase % 1.0) * period
+        self.deadline = None
+        self.ticks = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.lateness_last = 0.0
+        self.lateness_max = 0.0
+        self.lateness_sum = 0.0
+        self.duration_last = 0.0
+        self.duration_max = 0.0
+        self.duration_sum = 0.0
+
+    def next(self, now=None):
+        """
+        Return the next deadline, the first on the grid after the previous
+        one that is not already past.
+        """
+        if now is None:
+            now = monotonic()
+        k = floor((now - self.offset) / self.period)
+        if self.deadline is None:
+            deadline = self.offset + (k + 1) * self.period
+        else:
+            deadline = self.deadline + self.period
+            if deadline < now:
+                # Skip the ticks missed, but keep the current one
+                missed = k - round((self.deadline - self.offset) / self.period)
+                self.skipped += max(0, missed - 1)
+                deadline = self.offset + k * self.period
+        self.deadline = deadline
+        return deadline
+
+    def record(self, deadline, start, end):
+        """
+        Record the timing of a tick run from start to end.
+        """
+        lateness = max(0.0, start - deadline)
+        duration = end - start
+        self.ticks += 1
+        self.lateness_last = lateness
+        self.lateness_sum += lateness
+        self.lateness_max = max(self.lateness_max, lateness)
+        self.duration_last = duration
+        self.duration_sum += duration
+        self.duration_max = max(self.duration_max, duration)
+        if duration > self.period:
+            self.overruns += 1
+
+    def stats(self):
+        return {
+            "period": self.period,
+            "phase": round(self.offset / self.period, 3),
+            "ticks": self.ticks,
+            "skipped": self.skipped,
+            "overruns": self.overruns,
+            "lateness_last": round(self.lateness_last, 4),
+            "lateness_mean": (
+                round(self.lateness_sum / self.ticks, 4) if self.ticks else None
+            ),
+            "lateness_max": round(self.lateness_max, 4),
+            "duration_last": round(self.duration_last, 4),
+            "duration_mean": (
+                round(self.duration_sum / self.ticks, 4) if self.ticks else None
+            ),
+            "duration_max": round(self.duration_max, 4),
+        }
@@ -0,0 +1,51 @@
+import threading
+import time
+
+from okopilote.room.actuation import ActuatorHub
+
+
+class FakeValve:
+    def __init__(self, writes):
+        self.writes = writes
+
+    def open(self):
+        self.writes.append(time.monotonic())
+
+    def close(self):
+        self.writes.append(time.monotonic())
+
+    def release(self):
+        self.writes.append(time.monotonic())
+
+
+def test_orders_within_the_flush_delay_are_written_in_one_batch():
+    writes = []
+    hub = ActuatorHub(
+        flush_delay=0.5,
+        boards={"valve{}".format(i): "board" for i in range(8)},
+        get_device=lambda name: FakeValve(writes),
+    )
+    valves = [hub.get("valve{}".format(i)) for i in range(8)]
+    try:
+        for valve in valves:
+            valve.open()
+            time.sleep(0.01)
+        time.sleep(0.7)
+        assert len(writes) == 8
+        assert max(writes) - min(writes) < 0.05
+    finally:
+        hub.stop()
+
+
+def test_lone_valves_share_one_thread():
+    writes = []
+    hub = ActuatorHub(flush_delay=0.05, get_device=lambda name: FakeValve(writes))
+    before = threading.active_count()
+    try:
+        for i in range(50):
+            hub.get("valve{}".format(i)).open()
+        time.sleep(0.2)
+        assert len(writes) == 50
+        assert threading.active_count() - before == 1
+    finally:
+        hub.stop()
@@ -0,0 +1,109 @@
+import http.client
+import json
+import threading
+import time
+
+from okopilote.room.api import API
+from okopilote.room.snapshot import RoomSnapshot, heat_demand
+
+from .test_server import free_port
+from .test_shard import STATE
+
+
+class FakeRoom:
+    def __init__(self, **state):
+        self.snapshot = RoomSnapshot.from_dict(dict(STATE, **state))
+        self.snapshot.stamp()
+        self.offsets = []
+
+    def push_temp_set_offset(self, offset):
+        self.offsets.append(offset)
+
+
+class FakeApp:
+    def __init__(self):
+        self.rooms = {
+            "kitchen": FakeRoom(),
+            # Pushed an offset of 0.5 before: 19.7 - 20.0 - 0.5
+            "bedroom": FakeRoom(
+                room_id="bedroom", temp_set_offset=0.5, temp_deviation=-0.8
+            ),
+        }
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", path)
+    return conn, conn.getresponse()
+
+
+def start_api(app=None, **options):
+    port = free_port()
+    api = API(
+        app or FakeApp(), addr="127.0.0.1", port=port, server="threaded", **options
+    )
+    threading.Thread(target=api.start, daemon=True).start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            get(port, "/api/rooms/all")[0].close()
+            return port
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+
+def test_event_streams_are_limited():
+    port = start_api(workers=4, max_streams=1)
+    for i in range(2):
+        conn, resp = get(port, "/api/rooms/all/events?since=999999&timeout=0.1")
+        assert resp.status == 200
+        conn.close()
+    stream, resp = get(port, "/api/rooms/all/events")
+    try:
+        assert resp.status == 200
+        assert resp.fp.readline().startswith(b"id: ")
+        conn, resp = get(port, "/api/rooms/all/events?since=999999&timeout=0.1")
+        assert resp.status == 503
+        conn.close()
+        conn, resp = get(port, "/api/rooms/all")
+        assert resp.status == 200
+        conn.close()
+    finally:
+        stream.close()
+
+
+def test_rooms_without_offset_keep_their_own_deviation():
+    kitchen = RoomSnapshot.from_dict(STATE)
+    # Pushed an offset of 0.5 before: 19.7 - 20.0 - 0.5
+    bedroom = RoomSnapshot.from_dict(
+        dict(STATE, room_id="bedroom", temp_set_offset=0.5, temp_deviation=-0.8)
+    )
+    deviations, summary = heat_demand([kitchen, bedroom], {"kitchen": 1.0})
+    assert deviations == {"kitchen": -1.3, "bedroom": -0.8}
+    assert summary == {
+        "worst_deviation": -1.3,
+        "calling_for_heat": 2,
+        "weighted_demand": 2.1,
+    }
+
+
+def test_controller_sync_with_a_partial_rooms_map():
+    app = FakeApp()
+    port = start_api(app, workers=2)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request(
+        "POST",
+        "/api/rooms/all/controller_sync",
+        body=json.dumps({"rooms": {"kitchen": {"temp_set_offset": 1.0}}}),
+        headers={"Content-Type": "application/json"},
+    )
+    data = json.loads(conn.getresponse().read())
+    conn.close()
+    assert data["rooms"] == {
+        "kitchen": {"temp_deviation": -1.3},
+        "bedroom": {"temp_deviation": -0.8},
+    }
+    assert data["summary"]["calling_for_heat"] == 2
+    assert app.rooms["kitchen"].offsets == [1.0]
+    assert app.rooms["bedroom"].offsets == []
@@ -0,0 +1,27 @@
+import threading
+
+import pytest
+
+from okopilote.room.executor import DaemonExecutor
+from okopilote.room.sensors import SensorHub
+
+
+def test_shutdown_lets_the_threads_exit():
+    before = threading.active_count()
+    executor = DaemonExecutor(4, name="test")
+    assert executor.submit(pow, 2, 3).result() == 8
+    executor.shutdown()
+    assert threading.active_count() == before
+    with pytest.raises(RuntimeError):
+        executor.submit(pow, 2, 3)
+
+
+def test_stopped_sensor_hubs_do_not_leak_threads():
+    before = threading.active_count()
+    for i in range(5):
+        hub = SensorHub(workers=4, get_device=lambda name: None)
+        hub.stop()
+    for thread in threading.enumerate():
+        if thread.name.startswith("sensor-reader"):
+            thread.join(1.0)
+    assert threading.active_count() == before
@@ -0,0 +1,78 @@
+import os
+import time
+
+from okopilote.room.clock import VirtualClock
+from okopilote.room.history import COLUMNS, RECORD, HistoryStore
+
+# Start of the current segment, not to be compacted
+T0 = int(time.time()) // 86400 * 86400
+
+
+def test_rows_round_trip(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    for i in range(3):
+        store.append(T0 + 10 * i, temp=19.0 + i, valve_order=2)
+    rows = list(store.rows())
+    assert [r[0] for r in rows] == [T0, T0 + 10, T0 + 20]
+    store.close()
+
+
+def test_partial_record_is_dropped_on_open(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    store.append(T0, temp=19.0)
+    store.close()
+    (path,) = [os.path.join(str(tmp_path), n) for n in os.listdir(str(tmp_path))]
+    # A record half written when the process crashed
+    with open(path, "ab") as f:
+        f.write(RECORD.pack(T0 + 10, *[0] * len(COLUMNS))[:5])
+    store = HistoryStore(str(tmp_path))
+    store.append(T0 + 20, temp=20.0)
+    store.close()
+    assert os.path.getsize(path) == 2 * RECORD.size
+    assert [r[0] for r in store.rows()] == [T0, T0 + 20]
+
+
+def test_store_follows_its_clock(tmp_path):
+    clock = VirtualClock(86400 * 10)
+    store = HistoryStore(str(tmp_path), compact_after=86400, clock=clock)
+    store.append(clock.time(), temp=19.0)
+    store.flush()
+    clock.advance(3600)
+    # Would be too many buckets up to the time of the system
+    assert len(store.query(step=1, max_buckets=3601)["buckets"]) == 1
+    store.compact()
+    assert os.listdir(str(tmp_path)) == ["864000-0.bin"]
+    store.close()
+    clock.advance(86400 * 2)
+    store.compact()
+    assert os.listdir(str(tmp_path)) == ["864000-600.bin"]
+
+
+def test_compaction_keeps_the_max_of_the_states(tmp_path):
+    store = HistoryStore(str(tmp_path), compact_after=0)
+    store.append(86400, temp=19.0, valve_order=0, wind_opened=0)
+    store.append(86410, temp=20.0, valve_order=2, wind_opened=1)
+    store.append(86420, temp=21.0, valve_order=1, wind_opened=0)
+    store.close()
+    store.compact(now=86400 * 3)
+    assert list(store.rows()) == [(86400, 2000, -32768, -32768, -32768, 2, 1)]
+
+
+def test_rows_skip_a_segment_compacted_while_read(tmp_path):
+    clock = VirtualClock(86400)
+    store = HistoryStore(str(tmp_path), compact_after=0, clock=clock)
+    store.append(86400, temp=19.0)
+    store.append(86400 * 2, temp=20.0)
+    store.close()
+    clock.set(86400 * 3)
+    segments = store._segments
+
+    def listed():
+        # Compacted between the listing and the reading
+        store._segments = segments
+        result = segments()
+        store.compact()
+        return result
+
+    store._segments = listed
+    assert [r[0] for r in store.rows()] == [86400, 86400 * 2]
@@ -0,0 +1,23 @@
+from okopilote.room.loader import DeviceLoader, PendingDevice
+from okopilote.room.sensors import SensorHub
+
+
+class FakeSensor:
+    temperature = 19.5
+
+
+def test_unknown_devices_are_absent():
+    loader = DeviceLoader(lambda name: FakeSensor(), workers=1, names={"probe"})
+    hub = SensorHub(ttl=0, timeout=0, get_device=loader.get_device)
+    assert hub.get("typo") is None
+    sensor = hub.get("probe")
+    assert isinstance(sensor, PendingDevice)
+    loader.futures["probe"].result(1.0)
+    assert sensor.temperature == 19.5
+
+
+def test_any_device_is_set_up_without_names():
+    loader = DeviceLoader(lambda name: FakeSensor(), workers=1)
+    device = loader.get_device("probe")
+    loader.futures["probe"].result(1.0)
+    assert device.ready().temperature == 19.5
@@ -0,0 +1,40 @@
+import os
+import time
+
+from okopilote.room import persistence
+from okopilote.room.persistence import Persister, write_atomic
+
+
+def test_write_atomic(tmp_path):
+    path = str(tmp_path / "room.json")
+    write_atomic(path, "old")
+    write_atomic(path, "new")
+    with open(path) as f:
+        assert f.read() == "new"
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_edits_coalesce_into_one_write_per_interval(tmp_path, monkeypatch):
+    writes = []
+    monkeypatch.setattr(
+        persistence, "write_atomic", lambda path, data: writes.append((path, data))
+    )
+    persister = Persister(interval=1.0)
+    paths = [str(tmp_path / "a.json"), str(tmp_path / "b.json")]
+    try:
+        for i in range(20):
+            persister.write(paths[i % 2], str(i))
+            time.sleep(0.02)
+        time.sleep(1.0)
+        assert sorted(writes) == [(paths[0], "18"), (paths[1], "19")]
+    finally:
+        persister.stop()
+
+
+def test_stop_writes_pending_contents(tmp_path):
+    path = str(tmp_path / "room.json")
+    persister = Persister(interval=60.0)
+    persister.write(path, "data")
+    persister.stop()
+    with open(path) as f:
+        assert f.read() == "data"
@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+from okopilote.room.room import Room
+from okopilote.room.scheduler import ScheduleDispatcher
+
+
+class FakeSensor:
+    temperature = 19.5
+    humidity = 45.0
+    temperature_humidity = (19.5, 45.0)
+
+
+def test_publish_does_not_wait_for_the_scheduler_lock(tmp_path):
+    room = Room("kitchen", data_dir=str(tmp_path))
+    mode = room.sched.current_mode()
+    assert room.snapshot.sched_curr_mode == mode
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with room.sched.lock:
+            locked.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    try:
+        locked.wait(5)
+        start = time.monotonic()
+        room.temp = 19.5
+        room.publish()
+        assert time.monotonic() - start < 0.5
+        assert room.snapshot.temp == 19.5
+    finally:
+        release.set()
+        holder.join()
+
+
+def test_edits_update_the_cached_mode(tmp_path):
+    room = Room("kitchen", data_dir=str(tmp_path))
+    room.sched.schedule_onetime_temp(time.time() + 3600, 21.0)
+    assert room.sched.mode == "Onetime"
+    room.publish()
+    assert room.snapshot.sched_curr_mode == "Onetime"
+
+
+def test_dispatcher_failures_are_reported_by_the_room(tmp_path):
+    dispatcher = ScheduleDispatcher()
+    room = Room(
+        "kitchen",
+        temperature_sensor=FakeSensor(),
+        data_dir=str(tmp_path),
+        dispatcher=dispatcher,
+    )
+
+    def fail():
+        raise ValueError("broken preset")
+
+    room.sched.run_pending = fail
+    room.sched.schedule_onetime_temp(time.time() - 1, 21.0)
+    try:
+        dispatcher.add(room.sched)
+        deadline = time.monotonic() + 5
+        while room.sched_error is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        room._tick()
+        assert "Failed to run scheduler: broken preset" in room.snapshot.errors
+    finally:
+        dispatcher.stop()
+
+
+def test_dispatcher_drops_removed_schedulers(tmp_path):
+    dispatcher = ScheduleDispatcher()
+    rooms = [
+        Room(room_id, data_dir=str(tmp_path), dispatcher=dispatcher)
+        for room_id in ("kitchen", "bedroom")
+    ]
+    try:
+        for room in rooms:
+            dispatcher.add(room.sched)
+            for i in range(50):
+                room.sched.schedule_onetime_temp(time.time() + 3600 + i, 21.0)
+        assert len(dispatcher.queue) <= 2 * len(dispatcher.planned) + 16
+        dispatcher.remove(rooms[0].sched)
+        assert all(entry[2] is rooms[1].sched for entry in dispatcher.queue)
+    finally:
+        dispatcher.stop()
+
+
+def test_unknown_daily_preset_is_not_kept(tmp_path):
+    room = Room("kitchen", data_dir=str(tmp_path))
+    with pytest.raises(KeyError):
+        room.sched.schedule_daily_preset("tuesday", "nope")
+    assert room.sched.weekly_scheduling["tuesday"] is None
+    room.sched.schedule_daily_preset("wednesday", "at_home")
+    assert room.sched.weekly_scheduling["wednesday"] == "at_home"
+    assert room.sched.timeline
@@ -0,0 +1,42 @@
+import http.client
+import socket
+import threading
+import time
+
+from okopilote.room.server import ThreadedServer
+
+
+def app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", "2")])
+    return [b"ok"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_idle_connections_do_not_hold_the_workers():
+    port = free_port()
+    server = ThreadedServer(host="127.0.0.1", port=port, workers=2, request_timeout=0.5)
+    server.quiet = True
+    threading.Thread(target=server.run, args=(app,), daemon=True).start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            idle = [socket.create_connection(("127.0.0.1", port)) for i in range(2)]
+            break
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    try:
+        start = time.monotonic()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request("GET", "/")
+        assert conn.getresponse().read() == b"ok"
+        assert time.monotonic() - start < 2
+        conn.close()
+    finally:
+        for s in idle:
+            s.close()
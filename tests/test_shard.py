@@ -0,0 +1,153 @@
+import threading
+import time
+
+import pytest
+
+from okopilote.room.shard import SEQ, StateMirror, StateTable, assign_shards
+from okopilote.room.snapshot import RoomSnapshot
+
+STATE = {
+    "room_id": "kitchen",
+    "label": "Kitchen",
+    "temp": 19.5,
+    "temp_predict": 19.7,
+    "temp_set": 20.0,
+    "temp_set_offset": 0.0,
+    "temp_deviation": -0.3,
+    "temp_controlled": True,
+    "humid": None,
+    "valve_order": 2,
+    "wind_opened": False,
+    "heat_demand_weight": 1.0,
+    "errors": ["Failed to read humidity: timeout"],
+    "is_alive": True,
+    "sched_curr_mode": "here",
+}
+
+
+@pytest.fixture
+def table():
+    pytest.importorskip("multiprocessing.shared_memory")
+    table = StateTable(["kitchen", "bedroom"], workers=2)
+    yield table
+    table.close(unlink=True)
+
+
+def test_assign_shards_keeps_rooms_sharing_a_device_together():
+    room_confs = {
+        "kitchen": {"temperature_sensor_device": "t1", "radiator_valve_device": "v1"},
+        "dining": {"temperature_sensor_device": "t1", "radiator_valve_device": "v2"},
+        "bedroom": {"temperature_sensor_device": "t2", "radiator_valve_device": "v3"},
+        "office": {"temperature_sensor_device": "t3", "radiator_valve_device": "v4"},
+        "bathroom": {"temperature_sensor_device": "t4", "radiator_valve_device": "v5"},
+    }
+    device_confs = {
+        "v4": {"relay_device": "relay"},
+        "v5": {"relay_device": "relay"},
+        "relay": {"board_url": "/dev/ttyUSB0"},
+    }
+    shards = assign_shards(room_confs, device_confs, {}, 3)
+    assert sorted(map(sorted, shards)) == [
+        ["bathroom", "office"],
+        ["bedroom"],
+        ["dining", "kitchen"],
+    ]
+
+
+def test_assign_shards_keeps_rooms_of_a_board_together():
+    room_confs = {
+        "kitchen": {"radiator_valve_device": "v1"},
+        "bedroom": {"radiator_valve_device": "v2"},
+        "office": {"radiator_valve_device": "v3"},
+    }
+    boards = {"v1": "/dev/ttyUSB0", "v2": "/dev/ttyUSB0"}
+    shards = assign_shards(room_confs, {}, boards, 2)
+    assert sorted(map(sorted, shards)) == [["bedroom", "kitchen"], ["office"]]
+
+
+def test_assign_shards_drops_empty_shards():
+    room_confs = {"kitchen": {}, "bedroom": {}}
+    assert sorted(map(sorted, assign_shards(room_confs, {}, {}, 4))) == [
+        ["bedroom"],
+        ["kitchen"],
+    ]
+
+
+def test_snapshot_from_dict_round_trip():
+    snapshot = RoomSnapshot.from_dict(STATE)
+    assert snapshot.to_dict() == STATE
+    assert snapshot.version is None
+    assert snapshot.errors == ("Failed to read humidity: timeout",)
+    assert snapshot.same_state(RoomSnapshot.from_dict(dict(STATE)))
+    assert not snapshot.same_state(RoomSnapshot.from_dict(dict(STATE, temp=19.6)))
+
+
+def test_state_table_round_trip(table):
+    assert table.read("kitchen") == (0, None)
+    table.write(RoomSnapshot.from_dict(STATE), worker=1)
+    seq, state = table.read("kitchen")
+    assert seq == 2
+    expected = {k: v for k, v in STATE.items() if k not in ("room_id", "label")}
+    assert state == expected
+    assert table.read("bedroom") == (0, None)
+    assert table.counters() == bytes(8) + (1).to_bytes(8, "little")
+
+
+def test_state_table_shared_between_processes(table):
+    table.write(RoomSnapshot.from_dict(STATE), worker=0)
+    other = StateTable(table.room_ids, 2, name=table.name)
+    try:
+        assert other.read("kitchen") == table.read("kitchen")
+        # A new writer goes on from the sequence number of the row
+        other.write(RoomSnapshot.from_dict(dict(STATE, temp=20.0)), worker=0)
+        seq, state = table.read("kitchen")
+        assert seq == 4
+        assert state["temp"] == 20.0
+    finally:
+        other.close()
+
+
+def test_state_table_read_retries_a_torn_row(table):
+    table.write(RoomSnapshot.from_dict(STATE), worker=0)
+    offset = table._offset("kitchen")
+    # A write in progress: odd sequence number and a half-written row
+    SEQ.pack_into(table.buf, offset, 3)
+    table.buf[offset + SEQ.size : offset + SEQ.size + 8] = bytes(8)
+
+    def finish():
+        time.sleep(0.05)
+        table.write(RoomSnapshot.from_dict(dict(STATE, temp=21.0)), worker=0)
+
+    writer = threading.Thread(target=finish)
+    writer.start()
+    try:
+        seq, state = table.read("kitchen")
+    finally:
+        writer.join()
+    assert seq % 2 == 0
+    assert state["temp"] == 21.0
+
+
+def test_state_table_read_gives_up_on_a_row_left_torn(table):
+    table.write(RoomSnapshot.from_dict(STATE), worker=0)
+    SEQ.pack_into(table.buf, table._offset("kitchen"), 3)
+    assert table.read("kitchen", retries=100) == (3, None)
+
+
+def test_mirror_skips_a_row_left_torn(table):
+    table.write(RoomSnapshot.from_dict(STATE), worker=0)
+    mirror = StateMirror(table, {"kitchen": "Kitchen", "bedroom": "Bedroom"}, [])
+    assert mirror.snapshot("kitchen").temp == 19.5
+    # The writer died in the middle of a write
+    SEQ.pack_into(table.buf, table._offset("kitchen"), 3)
+    start = time.monotonic()
+    assert mirror.snapshot("kitchen").temp == 19.5
+    assert mirror.snapshot("kitchen").temp == 19.5
+    assert time.monotonic() - start < 1
+    # Written again by a new worker
+    other = StateTable(table.room_ids, 2, name=table.name)
+    try:
+        other.write(RoomSnapshot.from_dict(dict(STATE, temp=20.5)), worker=0)
+    finally:
+        other.close()
+    assert mirror.snapshot("kitchen").temp == 20.5